@@ -0,0 +1,129 @@
+"""
+Benchmarks of xmlformatter, run: python benchmark.py [name ...]
+"""
+import sys
+import time
+from context import xmlformatter
+
+
+def message(size):
+	""" Returns a XML message of at least size bytes. """
+	message = '<msg id="42" type="order"><from>alice</from><to>bob</to>%s</msg>'
+	items = []
+	length = len(message) - 2
+	while length < size:
+		items.append('<item id="%d"><name>item %d</name><qty>%d</qty><note>Hello <b>world</b></note></item>' % (len(items), len(items), len(items) % 7))
+		length += len(items[-1])
+	return (message % "".join(items)).encode("utf-8")
+
+
+def timed(function, repeat=3):
+	""" Returns the best time of repeated calls of function in seconds. """
+	best = None
+	for i in range(repeat):
+		started = time.perf_counter()
+		function()
+		elapsed = time.perf_counter() - started
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+def bench_documents():
+	""" Latency per message of format_string and format_documents. """
+	formatter = xmlformatter.Formatter(compress=True)
+	print("%-8s %8s %16s %20s" % ("size", "count", "format_string", "format_documents"))
+	for size in [200, 1000, 5000]:
+		msg = message(size)
+		count = max(200, 400000 // size)
+		messages = [msg] * count
+		single = timed(lambda: [formatter.format_string(m) for m in messages])
+		shared = timed(lambda: list(formatter.format_documents(messages)))
+		print("%-8d %8d %13.1f us %17.1f us" % (len(msg), count, single / count * 1e6, shared / count * 1e6))
+
+
+def bench_pretty_depth():
+	""" Output size and throughput by pretty depth. """
+	doc = b"<catalog>%s</catalog>" % b"".join(message(1000) for i in range(20))
+	print("%-12s %10s %8s %10s" % ("mode", "bytes", "ratio", "MB/s"))
+	compressed = None
+	for mode, options in [("compress", {"compress": True}), ("depth 0", {"pretty_depth": 0}), ("depth 1", {"pretty_depth": 1}), ("depth 2", {"pretty_depth": 2}), ("depth 3", {"pretty_depth": 3}), ("pretty", {})]:
+		formatter = xmlformatter.Formatter(**options)
+		result = formatter.format_string(doc)
+		compressed = compressed or len(result)
+		elapsed = timed(lambda: formatter.format_string(doc))
+		print("%-12s %10d %8.2f %10.2f" % (mode, len(result), len(result) / compressed, len(doc) / elapsed / 1e6))
+
+
+def bench_scaling():
+	""" Throughput by document size, mixed content included. """
+	print("%-10s %10s %10s %10s" % ("bytes", "pretty", "inline", "compress"))
+	for count in [10, 100, 1000]:
+		doc = b"<catalog>%s</catalog>" % b"".join(message(1000) for i in range(count))
+		speeds = []
+		for options in [{}, {"inline": True}, {"compress": True}]:
+			formatter = xmlformatter.Formatter(**options)
+			speeds.append(len(doc) / timed(lambda: formatter.format_string(doc), 1) / 1e6)
+		print("%-10d %7.2f MB/s %5.2f MB/s %5.2f MB/s" % ((len(doc),) + tuple(speeds)))
+
+
+def bench_whitespace():
+	""" Seconds by count of whitespaces inserted around mixed content. """
+	print("%-10s %10s %10s" % ("inserts", "reference", "compress"))
+	for count in [2000, 8000, 32000]:
+		doc = ("<p>%s</p>" % "".join("w%d<b>x</b><!--c--> y" % i for i in range(count))).encode("utf-8")
+		seconds = [timed(lambda: xmlformatter.Formatter(compress=engine == "compress", engine=engine).format_string(doc), 1) for engine in ["reference", "compress"]]
+		print("%-10d %8.2f s %8.2f s" % ((count,) + tuple(seconds)))
+
+
+def bench_engines():
+	""" Throughput of the formatting engines, compress mode. """
+	doc = b"<catalog>%s</catalog>" % b"".join(message(1000) for i in range(200))
+	print("%-12s %10s %8s" % ("engine", "MB/s", "speedup"))
+	reference = None
+	for engine in sorted(xmlformatter.Formatter.engines, key=lambda name: name != "reference"):
+		formatter = xmlformatter.Formatter(compress=True, engine=engine)
+		elapsed = timed(lambda: formatter.format_string(doc))
+		reference = reference or elapsed
+		print("%-12s %10.2f %7.2fx" % (engine, len(doc) / elapsed / 1e6, reference / elapsed))
+
+
+def bench_validate():
+	""" Throughput of validate compared with bare expat and formatting. """
+	doc = b"<catalog>%s</catalog>" % b"".join(message(1000) for i in range(2000))
+	formatter = xmlformatter.Formatter()
+	print("%-10s %10s" % ("mode", "MB/s"))
+	for mode, function in [
+		("expat", lambda: xmlformatter.xml.parsers.expat.ParserCreate().Parse(doc, True)),
+		("validate", lambda: formatter.validate(doc)),
+		("format", lambda: formatter.format_string(doc)),
+	]:
+		print("%-10s %10.2f" % (mode, len(doc) / timed(function, 1 if mode == "format" else 3) / 1e6))
+
+
+def bench_variants():
+	""" Rendering variants of one parse compared with formatting each variant. """
+	doc = b"<catalog>%s</catalog>" % b"".join(message(1000) for i in range(200))
+	variants = [{}, {"compress": True}, {"selfclose": True, "indent": 4}, {"pretty_depth": 1}]
+	formatter = xmlformatter.Formatter()
+	print("%-10s %10s %10s %8s" % ("variants", "separate", "shared", "speedup"))
+	for count in range(1, len(variants) + 1):
+		separate = timed(lambda: [xmlformatter.Formatter(**options).format_string(doc) for options in variants[:count]])
+		shared = timed(lambda: formatter.format_variants(doc, variants[:count]))
+		print("%-10d %8.3f s %8.3f s %7.2fx" % (count, separate, shared, separate / shared))
+
+
+BENCHMARKS = {
+	"documents": bench_documents,
+	"engines": bench_engines,
+	"pretty_depth": bench_pretty_depth,
+	"scaling": bench_scaling,
+	"validate": bench_validate,
+	"variants": bench_variants,
+	"whitespace": bench_whitespace,
+}
+
+
+if __name__ == "__main__":
+	for name in sys.argv[1:] or sorted(BENCHMARKS):
+		print("== %s: %s" % (name, BENCHMARKS[name].__doc__.strip()))
+		BENCHMARKS[name]()
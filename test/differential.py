@@ -0,0 +1,120 @@
+"""
+Differential test of the formatting engines, run: python differential.py [count] [seed]
+
+Formats random documents by every engine and option combination and
+compares the output with the reference engine. Reports mismatches and the
+speed of the engines relative to the reference engine.
+"""
+import itertools
+import random
+import sys
+import time
+from context import xmlformatter
+
+NAMES = ["a", "b", "c", "pre", "lit"]
+TEXTS = ["x", " y", "z ", " ", "\n  ", " p\tq ", "w\r\nv", "\n\n", "&amp;", "&lt;t&gt;", "&#65;", "&e;", "ä  "]
+DTD = """<!DOCTYPE root [
+<!ELEMENT root ANY>
+<!ELEMENT a (#PCDATA|b|c)*>
+<!ATTLIST a k CDATA #IMPLIED j CDATA "1">
+<!ENTITY e "entity">
+<!NOTATION n SYSTEM "n.txt">
+<!-- declarations -->
+]>
+"""
+OPTIONS = {
+	"compress": [False, True],
+	"selfclose": [False, True],
+	"selfclose_space": [False, True],
+	"inline": [True, False],
+	"correct": [True, False],
+	"indent": [2, 0],
+	"blanks": [False, True],
+	"eof_newline": [False, True],
+	"pretty_depth": [None, 1],
+	"preserve": [[], ["pre"], ["pre", "lit"], ["b"]],
+}
+
+
+def content(rng, depth=0):
+	""" Returns random content of an element. """
+	items = []
+	for i in range(rng.randint(0, 5)):
+		r = rng.random()
+		if r < 0.35 and depth < 6:
+			name = rng.choice(NAMES)
+			attrs = "".join(' %s="%s"' % (key, rng.choice(["1", "a&amp;b", "", "&quot;'"])) for key in rng.sample(["k", "j", "i"], rng.randint(0, 2)))
+			inner = content(rng, depth + 1)
+			if not inner and rng.random() < 0.5:
+				items.append("<%s%s/>" % (name, attrs))
+			else:
+				items.append("<%s%s>%s</%s>" % (name, attrs, inner, name))
+		elif r < 0.7:
+			items.append(rng.choice(TEXTS))
+		elif r < 0.8:
+			items.append("<!--%s-->" % rng.choice(["c", "\nd", " e ", "\r\n"]))
+		elif r < 0.88:
+			items.append("<?pi %s?>" % rng.choice(["", "data"]))
+		else:
+			items.append("<![CDATA[%s]]>" % rng.choice(["<x>", " s ", "", "&"]))
+	return "".join(items)
+
+
+def document(rng):
+	""" Returns a random well-formed document. """
+	prolog = '<?xml version="1.0"?>\n' if rng.random() < 0.7 else ""
+	body = "<root>%s</root>" % content(rng)
+	if rng.random() < 0.3:
+		prolog += DTD
+	else:
+		body = body.replace("&e;", "&#101;")
+	prolog += "<!-- head -->\n" if rng.random() < 0.2 else ""
+	return (prolog + body).encode("utf-8")
+
+
+def combinations():
+	""" Yields every option combination. """
+	keys = sorted(OPTIONS)
+	for values in itertools.product(*[OPTIONS[key] for key in keys]):
+		yield dict(zip(keys, values))
+
+
+def run(count=200, seed=1):
+	"""Formats count random documents by every engine, each by a random
+	option combination. Returns the mismatches as (engine, options,
+	document) and the seconds spent per engine on the documents the
+	engine applies to, together with the seconds of the reference engine."""
+	rng = random.Random(seed)
+	options = list(combinations())
+	mismatches = []
+	seconds = dict((engine, [0.0, 0.0]) for engine in xmlformatter.Formatter.engines if engine != "reference")
+	for i in range(count):
+		doc = document(rng)
+		opts = rng.choice(options)
+		started = time.perf_counter()
+		expected = xmlformatter.Formatter(**opts).format_string(doc)
+		elapsed = time.perf_counter() - started
+		for engine in seconds:
+			formatter = xmlformatter.Formatter(engine=engine, **opts)
+			if not xmlformatter.Formatter.engines[engine].applicable(formatter):
+				continue
+			started = time.perf_counter()
+			result = formatter.format_string(doc)
+			seconds[engine][0] += time.perf_counter() - started
+			seconds[engine][1] += elapsed
+			if result != expected:
+				mismatches.append((engine, opts, doc))
+	return mismatches, seconds
+
+
+if __name__ == "__main__":
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+	mismatches, seconds = run(count, seed)
+	for engine, opts, doc in mismatches[:5]:
+		print("MISMATCH %s %r\n%r" % (engine, opts, doc))
+	print("%-10s %10s %12s %8s" % ("engine", "seconds", "reference", "speedup"))
+	for engine, (spent, reference) in sorted(seconds.items()):
+		print("%-10s %10.3f %12.3f %7.2fx" % (engine, spent, reference, reference / spent if spent else 0))
+	print("%d mismatches of %d documents" % (len(mismatches), count))
+	sys.exit(1 if mismatches else 0)
@@ -1,8 +1,27 @@
+import asyncio
+import bz2
+import gzip
 import io
+import json
+import lzma
 import os
+import threading
 import unittest
+import urllib.error
+import urllib.request
+import wsgiref.simple_server
+import xml.etree.ElementTree as ET
+import xml.sax
+import xml.sax.handler
 from context import xmlformatter
+import differential
 import shutil
+import sys
+import tempfile
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+	def log_message(self, *args):
+		pass
 
 class TestXmlFormatter(unittest.TestCase):
 	
@@ -120,6 +139,388 @@ class TestXmlFormatter(unittest.TestCase):
 		self.formatter = xmlformatter.Formatter(selfclose=True, selfclose_space=True, indent="4")
 		self.assertEqual(self.formatter.format_file("t36.xml"), self.readfile("t36_selfclose_space.xml"))
 
+	def test_pretty_depth(self):
+		self.formatter = xmlformatter.Formatter(pretty_depth=2)
+		self.assertEqual(self.formatter.format_file("t37.xml"), self.readfile("t37_pretty_depth.xml"))
+		# Deep enough for every level:
+		self.formatter = xmlformatter.Formatter(pretty_depth=10)
+		self.assertEqual(self.formatter.format_file("t2.xml"), self.readfile("t2_pretty.xml"))
+		self.assertEqual(self.formatter.format_file("t8.xml"), self.readfile("t8_pretty.xml"))
+
+	def test_passthrough(self):
+		doc = b'<root><pre>\n  <b c="1" a="2"/><!--c--><?pi?>&amp;&gt;<![CDATA[ <x> ]]>\n</pre> <pre><b>x </b>y</pre></root>'
+		padded = b"<root><pre>\n  code\n  <b>more</b>\n</pre><pre> x<!--c--></pre></root>"
+		mixed = b"<root>a <pre>x <!--c--><b/></pre></root>"
+		for doc, kept in [(doc, None), (padded, True), (mixed, False)]:
+			for options in [{}, {"compress": True}, {"selfclose": True, "inline": False}, {"correct": False}]:
+				self.formatter = xmlformatter.Formatter(preserve=["pre"], **options)
+				token_list = xmlformatter.Formatter.TokenList(self.formatter)
+				token_list.parser.Parse(doc, True)
+				self.assertIn("Passthrough", [tk.name for tk in token_list])
+				result = str(token_list)
+				# Subtrees are expanded, if whitespaces are moved within or next to them:
+				if kept is not None:
+					self.assertEqual("Passthrough" in [tk.name for tk in token_list], kept or not self.formatter.correct)
+				token_list = xmlformatter.Formatter.TokenList(self.formatter)
+				token_list.passthrough_enabled = False
+				token_list.parser.Parse(doc, True)
+				self.assertNotIn("Passthrough", [tk.name for tk in token_list])
+				self.assertEqual(result, str(token_list))
+
+	def test_engines(self):
+		for engine in xmlformatter.Formatter.engines:
+			self.formatter = xmlformatter.Formatter(compress=True, engine=engine)
+			for name in ["t2", "t4", "t7", "t8", "t9", "t10", "t12", "t13", "t14", "t15", "t16", "t17", "t20"]:
+				self.assertEqual(self.formatter.format_file(name + ".xml"), self.readfile(name + "_compressed.xml"))
+			self.formatter = xmlformatter.Formatter(preserve=["precede"], compress=True, engine=engine)
+			self.assertEqual(self.formatter.format_file("t6.xml"), self.readfile("t6_compressed.xml"))
+		self.assertRaises(ValueError, xmlformatter.Formatter, engine="unknown")
+		mismatches, seconds = differential.run(300, 1)
+		self.assertEqual(mismatches, [])
+
+	def test_check(self):
+		self.formatter = xmlformatter.Formatter()
+		self.assertTrue(self.formatter.check_file("t1_pretty.xml"))
+		self.assertFalse(self.formatter.check_file("t1.xml"))
+		self.assertFalse(self.formatter.check_string(self.readfile("t1_pretty.xml") + b"\n"))
+		self.formatter = xmlformatter.Formatter(compress=True)
+		self.assertTrue(self.formatter.check_file("t2_compressed.xml"))
+		argv, stdout = sys.argv, sys.stdout
+		sys.argv = ["xmlformat", "--check", "t1.xml", "t1_pretty.xml", "t2.xml"]
+		sys.stdout = io.StringIO()
+		try:
+			with self.assertRaises(SystemExit) as context:
+				xmlformatter.cli()
+			output = sys.stdout.getvalue()
+		finally:
+			sys.argv, sys.stdout = argv, stdout
+		self.assertEqual(context.exception.code, 1)
+		self.assertEqual(output, "t1.xml\nt2.xml\n")
+
+	def test_validate(self):
+		self.formatter = xmlformatter.Formatter()
+		self.assertIsNone(self.formatter.validate("t1.xml"))
+		self.assertIsNone(self.formatter.validate(self.readfile("t2.xml")))
+		err = self.formatter.validate(b"<a>\n  <b></a>")
+		self.assertEqual((err.lineno, err.offset, err.byte_index), (2, 7, 11))
+		results = list(self.formatter.validate_many(["t1.xml", b"<a><b></a>", "t4.xml"], workers=2, processes=True))
+		self.assertIsNone(results[0])
+		self.assertEqual(results[1].byte_index, 8)
+		self.assertIsNone(results[2])
+		bogus = b'<?xml version="1.0" encoding="bogus"?><a/>'
+		self.assertIsInstance(self.formatter.validate(bogus), LookupError)
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		with open(os.path.join(root, "bogus.xml"), "wb") as fh:
+			fh.write(bogus)
+		with open(os.path.join(root, "bad.xml"), "wb") as fh:
+			fh.write(b"<a>")
+		argv, stdout = sys.argv, sys.stdout
+		sys.argv = ["xmlformat", "--validate", os.path.join(root, "bogus.xml"), "t1.xml", os.path.join(root, "bad.xml")]
+		sys.stdout = io.StringIO()
+		try:
+			with self.assertRaises(SystemExit) as context:
+				xmlformatter.cli()
+			output = sys.stdout.getvalue()
+		finally:
+			sys.argv, sys.stdout = argv, stdout
+		self.assertEqual(context.exception.code, 1)
+		self.assertEqual(output.splitlines(), [
+			"%s: unknown encoding: bogus" % os.path.join(root, "bogus.xml"),
+			"%s:1:3: byte 3: no element found" % os.path.join(root, "bad.xml"),
+		])
+
+	def test_format_tree(self):
+		for options in [{}, {"compress": True}, {"compress": True, "engine": "compress"}, {"preserve": ["pre"], "correct": False}]:
+			self.formatter = xmlformatter.Formatter(**options)
+			for name in ["t1", "t2", "t4", "t7", "t8", "t9", "t10", "t12", "t14", "t15", "t20"]:
+				parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True, insert_pis=True))
+				parser.feed(self.readfile(name + ".xml"))
+				root = parser.close()
+				self.assertEqual(self.formatter.format_tree(root), self.formatter.format_string(ET.tostring(root)))
+		root = ET.Element("{urn:a}root", {"{urn:b}k": "v\r\n\t", "j": "1"})
+		child = ET.SubElement(root, "{urn:a}c")
+		child.text = " text &amp; <\r\n" * 2000 + "\u00e4\u20ac"
+		child.tail = "tail "
+		child.append(ET.Comment(" c\r\n "))
+		child.append(ET.PI("pi", "data "))
+		self.formatter = xmlformatter.Formatter()
+		self.assertEqual(self.formatter.format_tree(ET.ElementTree(root)), self.formatter.format_string(ET.tostring(root)))
+
+	def test_sax_handler(self):
+		doc = b'<root xmlns:a="urn:a"><a:b a:k="1">text <c/> &amp; more<!--c--></a:b><?pi data?></root>'
+		self.formatter = xmlformatter.Formatter()
+		for namespaces in [False, True]:
+			handler = self.formatter.sax_handler()
+			parser = xml.sax.make_parser()
+			parser.setContentHandler(handler)
+			parser.setProperty(xml.sax.handler.property_lexical_handler, handler)
+			parser.setFeature(xml.sax.handler.feature_namespaces, namespaces)
+			parser.parse(io.BytesIO(doc))
+			self.assertEqual(handler.result(), self.formatter.format_string(doc))
+
+	def test_format_variants(self):
+		self.formatter = xmlformatter.Formatter()
+		variants = [{}, {"compress": True}, {"selfclose": True, "indent": "4"}, {"selfclose": True, "selfclose_space": True, "indent": "4"}]
+		for name in ["t2.xml", "t4.xml", "t36.xml"]:
+			expected = [xmlformatter.Formatter(**options).format_file(name) for options in variants]
+			self.assertEqual(self.formatter.format_variants(name, variants), expected)
+			self.assertEqual(self.formatter.format_variants(self.readfile(name), variants), expected)
+		self.formatter = xmlformatter.Formatter(compress=True, engine="compress")
+		self.assertEqual(self.formatter.format_variants(io.open("t2.xml", "rb"), [{}, {"compress": False}]), [self.readfile("t2_compressed.xml"), self.readfile("t2_pretty.xml")])
+		self.assertRaises(ValueError, self.formatter.format_variants, "t2.xml", [{"preserve": ["b"]}])
+
+	def test_format_documents(self):
+		self.formatter = xmlformatter.Formatter(compress=True)
+		documents = [self.readfile("t2.xml"), b"<root>", self.readfile("t4.xml"), self.readfile("t2.xml")]
+		results = list(self.formatter.format_documents(documents))
+		self.assertIsInstance(results.pop(1), xmlformatter.xml.parsers.expat.ExpatError)
+		self.assertEqual(results, [self.readfile("t2_compressed.xml"), self.readfile("t4_compressed.xml"), self.readfile("t2_compressed.xml")])
+		results = list(self.formatter.format_documents([b"<a/>", b'<?xml version="1.0" encoding="bogus"?><a/>', b"<b/>"]))
+		self.assertIsInstance(results.pop(1), LookupError)
+		self.assertEqual(results, [b"<a/>", b"<b/>"])
+		results = list(self.formatter.format_documents([b"<m> <b/></m><!--c--> <m/>", b"<m/>junk"]))
+		self.assertIsInstance(results.pop(1), xmlformatter.xml.parsers.expat.ExpatError)
+		self.assertEqual(results, [b"<m><b/></m><!--c--><m/>"])
+		self.formatter = xmlformatter.Formatter()
+		self.assertEqual(list(self.formatter.format_documents([b"<m><b/></m><m/>"])), [b"<m>\n  <b></b>\n</m>\n<m></m>"])
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		with open(os.path.join(root, "messages.log"), "wb") as fh:
+			fh.write(b'<m> <b/></m><m/>\n\n<?xml version="1.0"?><a> <b>x</b> </a>\n')
+		argv = sys.argv
+		sys.argv = ["xmlformat", "--lines", "--outfile", os.path.join(root, "out.log"), os.path.join(root, "messages.log")]
+		try:
+			xmlformatter.cli()
+		finally:
+			sys.argv = argv
+		self.assertEqual(self.readfile(os.path.join(root, "out.log")), b'<m><b/></m><m/>\n<?xml version="1.0" encoding="UTF-8"?><a><b>x</b></a>\n')
+
+	def test_format_many(self):
+		self.formatter = xmlformatter.Formatter()
+		sources = ["t1.xml", self.readfile("t2.xml"), io.open("t4.xml", "rb"), b"<root>", "t5.xml"]
+		expected = [self.readfile("t1_pretty.xml"), self.readfile("t2_pretty.xml"), self.readfile("t4_pretty.xml"), None, self.readfile("t5_pretty.xml")]
+		results = list(self.formatter.format_many(sources, workers=2))
+		self.assertIsInstance(results.pop(3), xmlformatter.xml.parsers.expat.ExpatError)
+		self.assertEqual(results, expected[:3] + expected[4:])
+		sources[2] = io.open("t4.xml", "rb")
+		results = dict(self.formatter.format_many(sources, workers=2, ordered=False, processes=True, chunksize=2))
+		self.assertIsInstance(results.pop(3), xmlformatter.xml.parsers.expat.ExpatError)
+		self.assertEqual(results, {0: expected[0], 1: expected[1], 2: expected[2], 4: expected[4]})
+
+	def test_recursive(self):
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		for path in ["a/b", "a/build", "a/gen", "a/regen", "build", "skip"]:
+			os.makedirs(os.path.join(root, path))
+		shutil.copyfile("t1.xml", os.path.join(root, "a", "t1.xml"))
+		shutil.copyfile("t2.xml", os.path.join(root, "a", "b", "t2.xml"))
+		shutil.copyfile("t4.xml", os.path.join(root, "build", "t4.xml"))
+		shutil.copyfile("t5.xml", os.path.join(root, "skip", "t5.xml"))
+		shutil.copyfile("t1.xml", os.path.join(root, "a", "t1.txt"))
+		for path in ["a/build", "a/gen", "a/regen"]:
+			shutil.copyfile("t1.xml", os.path.join(root, path, "t1.xml"))
+		with io.open(os.path.join(root, ".gitignore"), "w") as fh:
+			fh.write(u"build/\n**/gen\n")
+		expected = [os.path.join("a", "t1.xml"), os.path.join("a", "b", "t2.xml"), os.path.join("a", "regen", "t1.xml")]
+		for top in [root, root + os.sep]:
+			paths = [os.path.relpath(path, root) for path in xmlformatter.find_files(top, exclude=["skip"], gitignore=True)]
+			self.assertEqual(paths, expected)
+		argv = sys.argv
+		sys.argv = ["xmlformat", "--overwrite", "--exclude", "skip", "--gitignore", "-r", root]
+		try:
+			xmlformatter.cli()
+		finally:
+			sys.argv = argv
+		self.assertEqual(self.readfile(os.path.join(root, "a", "t1.xml")), self.readfile("t1_pretty.xml"))
+		self.assertEqual(self.readfile(os.path.join(root, "a", "b", "t2.xml")), self.readfile("t2_pretty.xml"))
+		self.assertEqual(self.readfile(os.path.join(root, "build", "t4.xml")), self.readfile("t4.xml"))
+		self.assertEqual(self.readfile(os.path.join(root, "skip", "t5.xml")), self.readfile("t5.xml"))
+
+	def test_compressed_files(self):
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		self.formatter = xmlformatter.Formatter(compression_level=1)
+		for name, module in [("t1.xml.gz", gzip), ("t1.xml.bz2", bz2), ("t1.xml.xz", lzma), ("t1.xml", gzip)]:
+			path = os.path.join(root, name)
+			with module.open(path, "wb") as fh:
+				fh.write(self.readfile("t1.xml"))
+			self.assertEqual(self.formatter.format_file(path), self.readfile("t1_pretty.xml"))
+			with io.open(path, "rb") as fh:
+				self.assertEqual(self.formatter.format_fileobj(fh), self.readfile("t1_pretty.xml"))
+			self.assertEqual(xmlformatter.read_file(path), self.readfile("t1.xml"))
+			with io.open(path, "rb") as fh:
+				self.assertEqual(self.formatter.format_source(io.BytesIO(fh.read())), self.readfile("t1_pretty.xml"))
+		for name, module in [("out.xml.gz", gzip), ("out.xml.bz2", bz2), ("out.xml.xz", lzma)]:
+			path = os.path.join(root, name)
+			argv = sys.argv
+			sys.argv = ["xmlformat", "--compression-level", "9", "--outfile", path, os.path.join(root, "t1.xml.xz")]
+			try:
+				xmlformatter.cli()
+			finally:
+				sys.argv = argv
+			with module.open(path, "rb") as fh:
+				self.assertEqual(fh.read(), self.readfile("t1_pretty.xml"))
+
+	def test_format_shards(self):
+		doc = b'<?xml version="1.0"?><dump><head/><records><rec id="1">a</rec><rec id="2"><b>b</b></rec><!--c--><rec id="3"/></records></dump>'
+		self.formatter = xmlformatter.Formatter(compress=True)
+		shards = [(b"".join(chunks), count) for chunks, count in self.formatter.format_shards(doc, 2, split_every=2)]
+		self.assertEqual(shards, [
+			(b'<?xml version="1.0" encoding="UTF-8"?>\n<dump><head/><records><rec id="1">a</rec><rec id="2"><b>b</b></rec><!--c--></records></dump>', 2),
+			(b'<?xml version="1.0" encoding="UTF-8"?>\n<dump><records><rec id="3"/></records></dump>', 1),
+		])
+		self.formatter = xmlformatter.Formatter()
+		shards = [(b"".join(chunks), count) for chunks, count in self.formatter.format_shards("t2.xml", split_bytes=1)]
+		self.assertEqual(sum(count for shard, count in shards), len(ET.fromstring(self.readfile("t2.xml"))))
+		for shard, count in shards:
+			self.assertEqual(count, len(ET.fromstring(shard)))
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		path = os.path.join(root, "out.xml.gz")
+		argv = sys.argv
+		sys.argv = ["xmlformat", "--compress", "--split-every", "1", "--split-depth", "2", "--outfile", path, "-"]
+		stdin = sys.stdin
+		sys.stdin = io.TextIOWrapper(io.BytesIO(doc))
+		try:
+			xmlformatter.cli()
+		finally:
+			sys.argv, sys.stdin = argv, stdin
+		with io.open(os.path.join(root, "out.manifest.json")) as fh:
+			manifest = json.load(fh)
+		self.assertEqual([(shard["file"], shard["elements"]) for shard in manifest["shards"]], [("out.0001.xml.gz", 1), ("out.0002.xml.gz", 1), ("out.0003.xml.gz", 1)])
+		with gzip.open(os.path.join(root, "out.0003.xml.gz"), "rb") as fh:
+			self.assertEqual(fh.read(), b'<?xml version="1.0" encoding="UTF-8"?>\n<dump><records><rec id="3"/></records></dump>')
+
+	def test_format_indexed(self):
+		doc = b'<dump><rec id="1"><v>\xc3\xa4</v></rec><rec id="2"/><pre><rec/></pre><rec>x</rec></dump>'
+		for options in [{}, {"compress": True}, {"selfclose": True, "preserve": ["pre"], "encoding_output": "UTF-16"}]:
+			self.formatter = xmlformatter.Formatter(**options)
+			index = []
+			result = b"".join(self.formatter.format_indexed(doc, index, key="id"))
+			self.assertEqual(result, self.formatter.format_string(doc))
+			self.assertEqual([(entry["name"], entry["key"]) for entry in index], [("rec", "1"), ("rec", "2"), ("pre", None), ("rec", None)])
+			elements = [result[entry["offset"]:entry["offset"] + entry["length"]] for entry in index]
+			self.assertEqual([ET.fromstring(element).get("id") for element in elements], ["1", "2", None, None])
+		index = []
+		list(xmlformatter.Formatter().format_indexed("t2.xml", index, depth=0))
+		self.assertEqual(index, [{"name": "root", "offset": 0, "length": 13}])
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		path = os.path.join(root, "t1.xml")
+		shutil.copyfile("t1.xml", path)
+		argv = sys.argv
+		sys.argv = ["xmlformat", "--overwrite", "--index", os.path.join(root, "t1.jsonl"), path]
+		try:
+			xmlformatter.cli()
+		finally:
+			sys.argv = argv
+		self.assertEqual(self.readfile(path), self.readfile("t1_pretty.xml"))
+		with io.open(os.path.join(root, "t1.jsonl")) as fh:
+			entries = [json.loads(line) for line in fh]
+		self.assertEqual(len(entries), 5)
+		self.assertEqual(self.readfile(path)[entries[0]["offset"]:entries[0]["offset"] + entries[0]["length"]], b"<em>war</em>")
+
+	def test_report(self):
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		for name in ["t1.xml", "t1_pretty.xml"]:
+			shutil.copyfile(name, os.path.join(root, name))
+		with io.open(os.path.join(root, "bad.xml"), "wb") as fh:
+			fh.write(b"<root>")
+		with io.open(os.path.join(root, "corrupt.xml"), "wb") as fh:
+			fh.write(gzip.compress(b"<root/>")[:-8] + b"corrupt!")
+		for jobs in ["1", "2"]:
+			report = os.path.join(root, "report%s.json" % jobs)
+			argv = sys.argv
+			sys.argv = ["xmlformat", "--overwrite", "--jobs", jobs, "--report", report, "-r", root, os.path.join(root, "missing.xml")]
+			try:
+				self.assertRaises(SystemExit, xmlformatter.cli)
+			finally:
+				sys.argv = argv
+			with io.open(report) as fh:
+				result = json.load(fh)
+			files = dict((os.path.basename(entry["path"]), entry) for entry in result["files"])
+			self.assertEqual(sorted(files), ["bad.xml", "corrupt.xml", "missing.xml", "t1.xml", "t1_pretty.xml"])
+			for name in ["bad.xml", "corrupt.xml", "missing.xml"]:
+				self.assertTrue(files[name]["error"])
+			self.assertEqual(files["t1.xml"]["rewritten"], jobs == "1")
+			self.assertFalse(files["t1_pretty.xml"]["rewritten"])
+			self.assertEqual(files["t1.xml"]["input_bytes"], len(self.readfile("t1.xml" if jobs == "1" else "t1_pretty.xml")))
+			self.assertEqual(files["t1.xml"]["output_bytes"], len(self.readfile("t1_pretty.xml")))
+			self.assertEqual(files["t1_pretty.xml"]["tokens"], 23)
+			summary = result["summary"]
+			self.assertEqual((summary["files"], summary["errors"], summary["rewritten"]), (5, 3, 1 if jobs == "1" else 0))
+			self.assertEqual(len(summary["slowest"]), 2)
+			self.assertEqual(self.readfile(os.path.join(root, "t1.xml")), self.readfile("t1_pretty.xml"))
+
+	def serve(self, app):
+		server = wsgiref.simple_server.make_server("127.0.0.1", 0, app, server_class=xmlformatter.WsgiServer, handler_class=QuietHandler)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+		return "http://127.0.0.1:%d" % server.server_port
+
+	def post(self, url, data):
+		try:
+			response = urllib.request.urlopen(urllib.request.Request(url, data=data))
+			return response.status, response.read()
+		except urllib.error.HTTPError as err:
+			return err.code, err.read()
+
+	def test_wsgi(self):
+		app = xmlformatter.WsgiApplication(workers=2, max_size=10000)
+		url = self.serve(app)
+		self.assertEqual(self.post(url, self.readfile("t1.xml")), (200, self.readfile("t1_pretty.xml")))
+		self.assertEqual(self.post(url + "/?compress=1", self.readfile("t2.xml")), (200, self.readfile("t2_compressed.xml")))
+		self.assertEqual(self.post(url + "/?preserve=precede", self.readfile("t6.xml")), (200, self.readfile("t6_pretty.xml")))
+		self.assertEqual(self.post(url, b"<root>")[0], 400)
+		self.assertEqual(self.post(url + "/?unknown=1", b"<root/>")[0], 400)
+		self.assertEqual(self.post(url + "/?outencoding=foo", b"<root/>")[0], 400)
+		self.assertEqual(self.post(url + "/?encoding=foo", b"<root/>")[0], 400)
+		self.assertEqual(self.post(url, b'<?xml version="1.0" encoding="bogus"?><root/>')[0], 400)
+		self.assertEqual(self.post(url, b"<root>" + b" " * 10000 + b"</root>")[0], 413)
+		metrics = urllib.request.urlopen(url + "/metrics").read().decode("utf-8")
+		self.assertIn('xmlformat_requests_total{code="200"} 3', metrics)
+		self.assertIn('xmlformat_requests_total{code="400"} 5', metrics)
+		self.assertIn('xmlformat_requests_total{code="413"} 1', metrics)
+		self.assertIn('xmlformat_request_duration_seconds_bucket{le="+Inf"} 9', metrics)
+
+	def test_wsgi_timeout(self):
+		app = xmlformatter.WsgiApplication(timeout=0)
+		url = self.serve(app)
+		self.assertEqual(self.post(url, self.readfile("t1.xml"))[0], 503)
+		self.assertIn('xmlformat_requests_total{code="503"} 1', app.metrics())
+		for length in ["abc", "-1"]:
+			environ = {"REQUEST_METHOD": "POST", "CONTENT_LENGTH": length, "wsgi.input": io.BytesIO(b"<root/>")}
+			statuses = []
+			body = b"".join(app(environ, lambda status, headers: statuses.append(status)))
+			self.assertEqual(statuses, ["400 Bad Request"])
+			self.assertEqual(body, ("Invalid Content-Length: %s\n" % length).encode("utf-8"))
+
+	def test_asgi(self):
+		app = xmlformatter.AsgiApplication(workers=2)
+		timeout = xmlformatter.AsgiApplication(timeout=0)
+		def request(body, query=b"", app=app):
+			messages = [{"type": "http.request", "body": body[:100], "more_body": True}, {"type": "http.request", "body": body[100:]}]
+			sent = []
+			async def receive():
+				return messages.pop(0)
+			async def send(message):
+				sent.append(message)
+			asyncio.run(app({"type": "http", "method": "POST", "path": "/", "query_string": query}, receive, send))
+			return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+		self.assertEqual(request(self.readfile("t1.xml")), (200, self.readfile("t1_pretty.xml")))
+		self.assertEqual(request(self.readfile("t4.xml"), b"compress=1"), (200, self.readfile("t4_compressed.xml")))
+		self.assertEqual(request(b"<root>")[0], 400)
+		self.assertEqual(request(b"<root/>", b"outencoding=foo")[0], 400)
+		self.assertEqual(request(b'<?xml version="1.0" encoding="bogus"?><root/>')[0], 400)
+		self.assertIn('xmlformat_requests_total{code="400"} 3', app.metrics())
+		self.assertEqual(request(self.readfile("t1.xml"), app=timeout)[0], 503)
+		self.assertIn('xmlformat_requests_total{code="503"} 1', timeout.metrics())
+
 
 if __name__ == '__main__':
 	unittest.main()
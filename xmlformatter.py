@@ -1,10 +1,30 @@
 """
 Format and compress XML documents 
 """
+import asyncio
+import bz2
+import codecs
+import collections
+import concurrent.futures
+import copy
+import fnmatch
 import getopt
+import gzip
+import io
+import itertools
+import json
+import lzma
+import os
 import re
+import socketserver
 import sys
+import threading
+import time
+import urllib.parse
+import wsgiref.simple_server
+import xml.etree.ElementTree
 import xml.parsers.expat
+import xml.sax.handler
 import html
 
 __version__ = "0.2.9"
@@ -22,10 +42,41 @@ DEFAULT_ENCODING_OUTPUT = None
 DEFAULT_EOF_NEWLINE = False
 DEFAULT_PERSERVE_ATTRIBUTES = False
 DEFAULT_ENCODE_ATTRIBUTES = False
+DEFAULT_PRETTY_DEPTH = None
+DEFAULT_ENGINE = "reference"
+DEFAULT_COMPRESSION_LEVEL = None
+DEFAULT_SPLIT_DEPTH = 1
+DEFAULT_INDEX_DEPTH = 1
+# Compressed files by magic bytes, file name extension and module:
+COMPRESSIONS = [
+    (b"\x1f\x8b", ".gz", gzip),
+    (b"BZh", ".bz2", bz2),
+    (b"\xfd7zXZ\x00", ".xz", lzma),
+]
+DEFAULT_CHUNK_SIZE = 65536
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_SIZE = 5000000
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_INCLUDE = ["*.xml"]
+DEFAULT_JOBS = 1
+DEFAULT_CHECK_CHUNK_SIZE = 4096
+DEFAULT_VALIDATE_CHUNK_SIZE = 1048576
+DEFAULT_REPORT_SLOWEST = 10
 
 class Formatter:
     # Use internal encoding:
     encoding_internal = None
+    # Options, which change the rendering only, see format_variants:
+    render_options = [
+        "blanks",
+        "compress",
+        "eof_newline",
+        "indent",
+        "indent_char",
+        "pretty_depth",
+        "selfclose",
+        "selfclose_space",
+    ]
 
     def __init__(
         self,
@@ -43,6 +94,9 @@ class Formatter:
         eof_newline=DEFAULT_EOF_NEWLINE,
         preserve_attributes=DEFAULT_PERSERVE_ATTRIBUTES,
         encode_attributes=DEFAULT_ENCODE_ATTRIBUTES,
+        pretty_depth=DEFAULT_PRETTY_DEPTH,
+        engine=DEFAULT_ENGINE,
+        compression_level=DEFAULT_COMPRESSION_LEVEL,
     ):
         # Minify the XML document:
         self.compress = compress
@@ -72,6 +126,14 @@ class Formatter:
         self.preserve_attributes = preserve_attributes
         # Decode entity references in attributes
         self.encode_attributes = encode_attributes
+        # Indent this number of levels below the root only, compress below:
+        self.pretty_depth = None if pretty_depth is None else int(pretty_depth)
+        # Format by the engine of this name, see Formatter.engines:
+        if engine not in Formatter.engines:
+            raise ValueError("unknown engine %s" % engine)
+        self.engine = engine
+        # Compress output files by this level, None for the default level:
+        self.compression_level = None if compression_level is None else int(compression_level)
 
     @property
     def encoding_effective(self, enc=None):
@@ -97,30 +159,416 @@ class Formatter:
         return strg.decode("utf-8").encode(self.encoding_effective)  # v2
 
     def enc_output(self, path, strg):
-        """ Output according to encoding """
+        """Output according to encoding, strg is encoded or an iterable of
+        encoded chunks. Files named *.gz, *.bz2 or *.xz are compressed."""
         fh = sys.stdout
         if strg is not None:
+            chunks = [strg] if isinstance(strg, bytes) else strg
             if path is not None:
-                open(path, "w+b").write(strg)
+                with open_output(path, self.compression_level) as out:
+                    for chunk in chunks:
+                        out.write(chunk)
             elif sys.version_info > (3, 0):
-                fh.buffer.write(strg)
+                for chunk in chunks:
+                    fh.buffer.write(chunk)
             else:
-                fh.write(strg)
+                for chunk in chunks:
+                    fh.write(chunk)
+
+    def enc_iterencode(self, pieces, size=DEFAULT_CHUNK_SIZE):
+        """ Encode pieces of a formatted XML document in target, joined to chunks of about size """
+        encoder = codecs.getincrementalencoder(self.encoding_effective)()
+        buf = []
+        length = 0
+        for piece in pieces:
+            buf.append(piece)
+            length += len(piece)
+            if length >= size:
+                yield encoder.encode("".join(buf))
+                buf = []
+                length = 0
+        chunk = encoder.encode("".join(buf), True)
+        if chunk:
+            yield chunk
+
+    def eof_ending(self, last):
+        """ Returns the newline ending a document after its last piece, if eof_newline. """
+        if self.eof_newline and not last.endswith("\n"):
+            return "\n"
+        return ""
+
+    def enc_compare(self, chunks, data):
+        """ Returns True, if encoded chunks equal data - stops at the first difference """
+        view = memoryview(data)
+        pos = 0
+        for chunk in chunks:
+            end = pos + len(chunk)
+            if view[pos:end] != chunk:
+                return False
+            pos = end
+        return pos == len(data)
+
+    def token_list(self):
+        """ Returns an empty token list of the engine, or of the reference engine, if the engine doesn't apply """
+        engine = Formatter.engines[self.engine]
+        if not engine.applicable(self):
+            engine = Formatter.TokenList
+        return engine(self)
+
+    def check_string(self, xmldoc=b""):
+        """ Returns True, if a XML document given by xmldoc is formatted already """
+        token_list = self.token_list()
+        token_list.parser.Parse(xmldoc, True)
+        if not isinstance(xmldoc, bytes):
+            xmldoc = xmldoc.encode(self.encoding_effective)
+        return self.enc_compare(
+            self.enc_iterencode(token_list.render(), DEFAULT_CHECK_CHUNK_SIZE), xmldoc
+        )
+
+    def check_file(self, file):
+        """ Returns True, if a XML document given by path name is formatted already """
+        return self.check_string(read_file(file))
 
     def format_string(self, xmldoc=""):
         """ Format a XML document given by xmldoc """
-        token_list = Formatter.TokenList(self)
+        token_list = self.token_list()
         token_list.parser.Parse(xmldoc, True)
         return self.enc_encode(str(token_list))
 
     def format_file(self, file):
-        """ Format a XML document given by path name """
-        fh = open(file, "rb")
-        token_list = Formatter.TokenList(self)
+        """ Format a XML document given by path name, compressed files are decompressed while parsing """
+        fh = open_input(file)
+        token_list = self.token_list()
         token_list.parser.ParseFile(fh)
         fh.close()
         return self.enc_encode(str(token_list))
 
+    def format_fileobj(self, fh):
+        """ Format a XML document given by a binary file object, compressed files are decompressed while parsing """
+        token_list = self.token_list()
+        token_list.parser.ParseFile(decompress_fileobj(fh))
+        return self.enc_encode(str(token_list))
+
+    def format_source(self, source):
+        """ Format a XML document given by path name, bytes or file object """
+        if hasattr(source, "read"):
+            return self.format_fileobj(source)
+        elif isinstance(source, (bytes, bytearray)):
+            return self.format_string(source)
+        return self.format_file(source)
+
+    def format_measured(self, source):
+        """Format a XML document given by path name, bytes or file object.
+        Returns the formatted document and a dict of its input_bytes,
+        output_bytes, tokens, parse_seconds, format_seconds and changed,
+        True if the formatted document differs from the input."""
+        if hasattr(source, "read"):
+            source = source.read()
+        elif not isinstance(source, (bytes, bytearray)):
+            source = read_file(source)
+        started = time.perf_counter()
+        token_list = self.token_list()
+        token_list.parser.Parse(source, True)
+        parsed = time.perf_counter()
+        result = self.enc_encode(str(token_list))
+        formatted = time.perf_counter()
+        return result, {
+            "input_bytes": len(source),
+            "output_bytes": len(result),
+            "tokens": len(token_list),
+            "parse_seconds": parsed - started,
+            "format_seconds": formatted - parsed,
+            "changed": result != source,
+        }
+
+    def format_variants(self, source, variants):
+        """Format a XML document given by path name, bytes or file object by
+        every variant, a dict of rendering options (see render_options)
+        overriding the options of the Formatter. The document is parsed and
+        its tokens are configured once. Returns the formatted documents in
+        order of variants."""
+        formatters = []
+        for options in variants:
+            unknown = sorted(set(options) - set(Formatter.render_options))
+            if unknown:
+                raise ValueError("no rendering option: %s" % ", ".join(unknown))
+            options = dict(options)
+            if "indent" in options:
+                options["indent"] = int(options["indent"])
+            if options.get("pretty_depth") is not None:
+                options["pretty_depth"] = int(options["pretty_depth"])
+            formatters.append(options)
+        # The tokens reference a copy of the Formatter, which renders every variant:
+        formatter = copy.copy(self)
+        engine = Formatter.engines[self.engine]
+        for options in formatters:
+            variant = copy.copy(formatter)
+            variant.__dict__.update(options)
+            if not engine.applicable(variant):
+                engine = Formatter.TokenList
+        token_list = engine(formatter)
+        self.parse_source(token_list, source)
+        token_list.prepare()
+        base = dict((option, getattr(self, option)) for option in Formatter.render_options)
+        results = []
+        for options in formatters:
+            formatter.__dict__.update(base, **options)
+            results.append(formatter.enc_encode("".join(token_list.render())))
+        return results
+
+    def format_shards(self, source, depth=DEFAULT_SPLIT_DEPTH, split_bytes=None, split_every=None):
+        """Format a XML document given by path name, bytes or file object
+        into well-formed shards split before elements at depth. A shard
+        takes split_every elements or as many elements as fit into
+        split_bytes bytes, at least one. Every shard starts with the prolog
+        of the document, the XML declaration included, and re-opens the
+        ancestors of its elements. Elements within preserved elements are
+        not split. Yields (chunks, count) per shard, the
+        encoded chunks of the shard and the number of its elements."""
+        token_list = Formatter.TokenList(self)
+        self.parse_source(token_list, source)
+        token_list.prepare()
+        encoding = self.encoding_effective
+        # End tokens of the ancestors by the positions of their start tokens:
+        ends = {}
+        stack = []
+        for tk in token_list:
+            if tk.level < depth:
+                if tk.name == "StartElement":
+                    stack.append(tk.pos)
+                elif tk.name == "EndElement":
+                    ends[stack.pop()] = tk
+        prolog = None
+        ancestors = []
+        closing = 0
+        pieces = []
+        size = 0
+        count = 0
+        element = None
+        for tk, piece in token_list.render_tokens():
+            # Every shard is ended by shard_close:
+            if tk is None:
+                continue
+            if element is not None:
+                element.append(piece)
+                if tk.name != "EndElement" or tk.level != depth:
+                    continue
+                length = sum(len(piece.encode(encoding)) for piece in element)
+                if count and (
+                    (split_every and count >= split_every)
+                    or (split_bytes and size + length + closing > split_bytes)
+                ):
+                    yield self.enc_iterencode(self.shard_close(pieces, ancestors, ends)), count
+                    pieces = prolog + [str(start) for start in ancestors]
+                    size = sum(len(piece.encode(encoding)) for piece in pieces)
+                    count = 0
+                pieces.extend(element)
+                size += length
+                count += 1
+                element = None
+                continue
+            if tk.name == "StartElement":
+                if prolog is None:
+                    prolog = list(pieces)
+                    if token_list[0].name != "XmlDecl":
+                        prolog.insert(0, '<?xml version="1.0" encoding="%s"?>\n' % encoding)
+                        pieces.insert(0, prolog[0])
+                        size += len(prolog[0].encode(encoding))
+                # Preserved elements are kept whole:
+                if tk.level == depth and tk.preserve != 2:
+                    element = [piece]
+                    continue
+                if tk.level < depth:
+                    ancestors.append(tk)
+                    closing += len(str(ends[tk.pos]).encode(encoding))
+            elif tk.name == "EndElement" and tk.level < depth:
+                ancestors.pop()
+                closing -= len(piece.encode(encoding))
+            if piece:
+                pieces.append(piece)
+                size += len(piece.encode(encoding))
+        yield self.enc_iterencode(self.shard_close(pieces, [], ends)), count
+
+    def format_indexed(self, source, index, depth=DEFAULT_INDEX_DEPTH, key=None):
+        """Format a XML document given by path name, bytes or file object.
+        Returns an iterator of the encoded chunks of the formatted document,
+        which appends a dict of name, offset and length in bytes of the
+        output to index for every element at depth, by the value of the
+        attribute key too, if key is given. Elements within preserved
+        elements are skipped. The document is parsed before returning, so
+        the source may be overwritten by the chunks."""
+        token_list = Formatter.TokenList(self)
+        self.parse_source(token_list, source)
+        token_list.prepare()
+        return self.index_chunks(token_list, index, depth, key)
+
+    def index_chunks(self, token_list, index, depth, key):
+        """ Returns the encoded chunks of a prepared token_list, see format_indexed. """
+        return self.enc_iterencode(self.index_pieces(token_list, index, depth, key))
+
+    def index_pieces(self, token_list, index, depth, key):
+        """Yields the pieces rendered by token_list and appends an entry to
+        index for every element at depth. Offsets count the pieces encoded
+        by an encoder of their own, which encodes like enc_iterencode."""
+        encoder = codecs.getincrementalencoder(self.encoding_effective)()
+        pos = 0
+        entry = None
+        for tk, piece in token_list.render_tokens():
+            if (
+                entry is None
+                and tk is not None
+                and tk.name == "StartElement"
+                and tk.level == depth
+                and tk.preserve != 2
+            ):
+                # Indenting whitespaces aren't part of the element:
+                start = piece.index("<")
+                pos += len(encoder.encode(piece[:start]))
+                yield piece[:start]
+                piece = piece[start:]
+                entry = {"name": tk.arg[0], "offset": pos, "length": 0}
+                if key is not None:
+                    entry["key"] = tk.arg[1].get(key)
+                index.append(entry)
+            pos += len(encoder.encode(piece))
+            yield piece
+            if entry is not None and tk.name == "EndElement" and tk.level == depth:
+                entry["length"] = pos - entry["offset"]
+                entry = None
+
+    def shard_close(self, pieces, ancestors, ends):
+        """ Close the ancestors of a shard given by its pieces. """
+        pieces.extend(str(ends[start.pos]) for start in reversed(ancestors))
+        pieces = [piece for piece in pieces if piece]
+        if pieces:
+            pieces.append(self.eof_ending(pieces[-1]))
+        return pieces
+
+    def parse_source(self, token_list, source):
+        """ Parse a XML document given by path name, bytes or file object into token_list. """
+        if hasattr(source, "read"):
+            token_list.parser.ParseFile(decompress_fileobj(source))
+        elif isinstance(source, (bytes, bytearray)):
+            token_list.parser.Parse(source, True)
+        else:
+            with open_input(source) as fh:
+                token_list.parser.ParseFile(fh)
+
+    def format_many(
+        self, sources, workers=DEFAULT_WORKERS, ordered=True, processes=False, chunksize=1
+    ):
+        """Format XML documents given by path names, bytes or file objects
+        by a pool of threads, or processes. Yields the formatted documents or
+        the exception raised for a document in order of sources. Yields pairs
+        of (index, result) in order of completion, if ordered is False. Every
+        worker formats by its own copy of the Formatter, which is pickled once
+        per worker process. chunksize documents are passed to a worker at once."""
+        return self.apply_many("format_source", sources, workers, ordered, processes, chunksize)
+
+    def validate_many(
+        self, sources, workers=DEFAULT_WORKERS, ordered=True, processes=False, chunksize=1
+    ):
+        """Check XML documents given by path names, bytes or file objects to
+        be well-formed like format_many. Yields the results of validate."""
+        return self.apply_many("validate", sources, workers, ordered, processes, chunksize)
+
+    def apply_many(self, method, sources, workers, ordered, processes, chunksize):
+        """ Apply method of the Formatter to sources by a pool of threads, or processes, see format_many. """
+        if processes:
+            pool = concurrent.futures.ProcessPoolExecutor
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor
+        executor = pool(workers, initializer=format_many_init, initargs=(self,))
+        chunks = format_many_chunks(sources, chunksize, processes)
+        if ordered:
+            return format_many_ordered(executor, chunks, workers * 2, method)
+        return format_many_unordered(executor, chunks, workers * 2, method)
+
+    def validate(self, source):
+        """Returns None, if a XML document given by path name, bytes or file
+        object is well-formed, otherwise the ExpatError. The error has
+        lineno, offset (the column) and byte_index. Returns the LookupError
+        for an unknown encoding. Expat runs without any handlers, so no
+        tokens are built."""
+        parser = xml.parsers.expat.ParserCreate(encoding=self.encoding_input)
+        parser.SetParamEntityParsing(xml.parsers.expat.XML_PARAM_ENTITY_PARSING_NEVER)
+        try:
+            if hasattr(source, "read"):
+                parser.ParseFile(decompress_fileobj(source))
+            elif isinstance(source, (bytes, bytearray)):
+                parser.Parse(source, True)
+            else:
+                for chunk in read_chunks(source, DEFAULT_VALIDATE_CHUNK_SIZE):
+                    parser.Parse(chunk, False)
+                parser.Parse(b"", True)
+        except xml.parsers.expat.ExpatError as err:
+            err.byte_index = parser.ErrorByteIndex
+            return err
+        except LookupError as err:
+            return err
+        return None
+
+    def format_documents(self, documents):
+        """Format XML documents given by an iterable of strings, yields the
+        formatted documents or the exception raised for a document. The
+        token list, its handlers and the interned names are shared between
+        the documents to keep the setup per document small. A string of
+        concatenated documents, e.g. <a/><b/>, yields them formatted and
+        joined, by a newline unless compressed."""
+        token_list = self.token_list()
+        for xmldoc in documents:
+            self.encoding_internal = None
+            try:
+                yield self.enc_encode(
+                    ("" if self.compress else "\n").join(self.format_concatenated(token_list, xmldoc))
+                )
+            except Exception as err:
+                yield err
+            finally:
+                token_list.reset()
+
+    def format_concatenated(self, token_list, xmldoc):
+        """Returns the formatted documents of a string of concatenated
+        documents. The parser restarts where the previous root was closed."""
+        results = []
+        while True:
+            try:
+                token_list.parser.Parse(xmldoc, True)
+                results.append(str(token_list))
+                return results
+            except xml.parsers.expat.ExpatError as err:
+                # Content after the root starting another document:
+                junk = xml.parsers.expat.errors.XML_ERROR_JUNK_AFTER_DOC_ELEMENT
+                if err.code != xml.parsers.expat.errors.codes[junk]:
+                    raise
+                index = token_list.parser.ErrorByteIndex
+                results.append(str(token_list))
+                token_list.reset()
+                if not isinstance(xmldoc, (bytes, bytearray)):
+                    xmldoc = xmldoc.encode("utf-8")
+                xmldoc = xmldoc[index:]
+
+    def format_tree(self, element):
+        """Format an ElementTree element or tree without serializing and
+        parsing it again. The result equals format_string(ET.tostring(element))."""
+        if hasattr(element, "getroot"):
+            element = element.getroot()
+        token_list = self.token_list()
+        tree_feed(dict(token_list.handlers), element, token_list.parser.buffer_size)
+        return self.enc_encode(str(token_list))
+
+    def sax_handler(self):
+        """ Returns a SAX content handler, which formats the events it receives, see SaxHandler """
+        return SaxHandler(self)
+
+    def format_stream(self, chunks):
+        """ Format a XML document given by an iterable of chunks, returns an iterator of encoded chunks """
+        token_list = self.token_list()
+        for chunk in chunks:
+            token_list.parser.Parse(chunk, False)
+        token_list.parser.Parse(b"", True)
+        return self.enc_iterencode(token_list.render())
+
     class TokenList:
         # Being in a cdata section:
         cdata_section = False
@@ -134,39 +582,83 @@ class Formatter:
         level_counter = 0
         # Lock deletion of whitespaces:
         preserve_level = None
+        # Formatting steps are done:
+        prepared = False
+        # Collect subtrees of preserved elements as parser events instead of tokens:
+        passthrough_enabled = True
+        # Parser events of the collected subtree:
+        passthrough = None
+        # Preserved element of the collected subtree:
+        passthrough_element = None
+        # Nesting of elements within the collected subtree:
+        passthrough_depth = 0
+        # Lock collecting below the level of a preserved element:
+        passthrough_lock = None
+
+        # Properties of a document, see reset():
+        document_properties = [
+            "cdata_section",
+            "desc_mixed_level",
+            "indent_level",
+            "level_counter",
+            "preserve_level",
+            "prepared",
+            "passthrough",
+            "passthrough_element",
+            "passthrough_depth",
+            "passthrough_lock",
+        ]
+
+        def __init__(self, formatter, intern=None):
+            self.formatter = formatter
+            # Share interned names between the parsers of the token list:
+            self.intern = {} if intern is None else intern
+            # Push tokens to buffer:
+            self.handlers = [
+                (pattern % "Handler", self.xml_handler(pattern % ""))
+                for pattern in [
+                    "XmlDecl%s",
+                    "ElementDecl%s",
+                    "AttlistDecl%s",
+                    "EntityDecl%s",
+                    "StartElement%s",
+                    "EndElement%s",
+                    "ProcessingInstruction%s",
+                    "CharacterData%s",
+                    "Comment%s",
+                    "Default%s",
+                    "StartDoctypeDecl%s",
+                    "EndDoctypeDecl%s",
+                    "StartCdataSection%s",
+                    "EndCdataSection%s",
+                    "NotationDecl%s",
+                ]
+            ]
+            self.reset()
+
+        @classmethod
+        def applicable(cls, formatter):
+            """ Returns True, if the token list formats documents of formatter. """
+            return True
 
-        def __init__(self, formatter):
+        def reset(self):
+            """ Start a new document by an empty token list and a new parser. """
             # Keep tokens in a list:
             self._list = []
-            self.formatter = formatter
+            # Open elements while parsing:
+            self.parse_elements = []
+            # Subtrees kept as parser events:
+            self.passthroughs = []
+            for name in self.document_properties:
+                self.__dict__.pop(name, None)
             self.parser = xml.parsers.expat.ParserCreate(
-                encoding=self.formatter.encoding_input
+                encoding=self.formatter.encoding_input, intern=self.intern
             )
             self.parser.specified_attributes = 1
             self.parser.buffer_text = True
             self.parser.SetParamEntityParsing(xml.parsers.expat.XML_PARAM_ENTITY_PARSING_NEVER)
-
-            # Push tokens to buffer:
-            for pattern in [
-                "XmlDecl%s",
-                "ElementDecl%s",
-                "AttlistDecl%s",
-                "EntityDecl%s",
-                "StartElement%s",
-                "EndElement%s",
-                "ProcessingInstruction%s",
-                "CharacterData%s",
-                "Comment%s",
-                "Default%s",
-                "StartDoctypeDecl%s",
-                "EndDoctypeDecl%s",
-                "StartCdataSection%s",
-                "EndCdataSection%s",
-                "NotationDecl%s",
-            ]:
-                setattr(
-                    self.parser, pattern % "Handler", self.xml_handler(pattern % "")
-                )
+            for name, handler in self.handlers:
+                setattr(self.parser, name, handler)
 
         def __iter__(self):
             return iter(self._list)
@@ -188,20 +680,146 @@ class Formatter:
 
         def __str__(self):
             """ Returns the formatted XML document in UTF-8. """
-            for step in ["configure", "pre_operate", "post_operate"]:
-                for tk in iter(self):
-                    getattr(tk, step)()
-            result = ""
+            return "".join(self.render())
+
+        def prepare(self):
+            """Apply the formatting steps to every token once. Tokens are
+            configured in a single pass. Afterwards character data moves
+            whitespaces, which looks ahead at configured tokens. Inserted
+            whitespaces are collected and spliced in at once. Deleting
+            whitespaces is left to rendering, see CharacterData."""
+            if not self.prepared:
+                if self.passthroughs:
+                    self.passthrough_expand()
+                self.open_elements = []
+                # Whitespaces to insert by the position of the next token:
+                self.inserts = {}
+                texts = []
+                for tk in self._list:
+                    tk.configure()
+                    if tk.name == "CharacterData":
+                        texts.append(tk)
+                for tk in texts:
+                    tk.pre_operate()
+                if self.inserts:
+                    tokens = []
+                    for tk in self._list:
+                        tokens.extend(self.inserts.get(tk.pos, ()))
+                        tokens.append(tk)
+                    for pos, tk in enumerate(tokens):
+                        tk.pos = pos
+                    self._list = tokens
+                self.prepared = True
+
+        def render(self):
+            """ Yields the formatted XML document piece by piece. """
+            for tk, piece in self.render_tokens():
+                if piece:
+                    yield piece
+
+        def render_tokens(self):
+            """Yields pairs of every token and its formatted piece, which may
+            be empty. The newline ending the document is yielded with None."""
+            self.prepare()
+            last = ""
             for tk in iter(self):
-                result += str(tk)
-            if self.formatter.eof_newline and not result.endswith("\n"):
-                result += "\n"
-            return result
+                piece = str(tk)
+                if piece:
+                    last = piece
+                yield tk, piece
+            ending = self.formatter.eof_ending(last)
+            if ending:
+                yield None, ending
 
         def append(self, tk):
             """ Add token to tokenlist. """
             tk.pos = len(self._list)
             self._list.append(tk)
+            # Content models are known, when the parent is closed:
+            if tk.name == "StartElement":
+                tk.content_model = 0
+                if self.parse_elements:
+                    self.parse_elements[-1].content_model |= 1
+                self.parse_elements.append(tk)
+                if (
+                    self.passthrough_lock is None
+                    and self.passthrough_enabled
+                    and tk.arg[0] in self.formatter.preserve
+                ):
+                    self.passthrough = []
+                    self.passthrough_element = tk
+            elif tk.name == "EndElement":
+                self.parse_elements.pop()
+                if tk.level == self.passthrough_lock:
+                    self.passthrough_lock = None
+            elif (
+                tk.name == "CharacterData"
+                and self.parse_elements
+                and not Formatter.Token.re_blank.match(tk.arg[0])
+            ):
+                self.parse_elements[-1].content_model |= 2
+
+        def passthrough_event(self, key, arg):
+            """Collect a parser event of a preserved subtree. Fall back to
+            tokens for events, which aren't kept as is. Subtrees, whose
+            whitespaces could be moved, are expanded by prepare."""
+            if key == "EndElement" and self.passthrough_depth == 0:
+                self.passthrough_end()
+                self.append(self.formatter.EndElement(self, arg))
+                return
+            self.passthrough.append((key, arg))
+            if key == "StartElement":
+                self.passthrough_depth += 1
+            elif key == "EndElement":
+                self.passthrough_depth -= 1
+            elif key not in [
+                "CharacterData",
+                "Comment",
+                "ProcessingInstruction",
+                "StartCdataSection",
+                "EndCdataSection",
+            ]:
+                self.passthrough_replay()
+
+        def passthrough_end(self):
+            """ Add the collected subtree as a single token. """
+            events = self.passthrough
+            self.passthrough = None
+            if events:
+                tk = self.formatter.Passthrough(self, [events])
+                self.passthrough_element.content_model = tk.models.pop(None)
+                self.append(tk)
+                self.passthroughs.append(tk)
+
+        def passthrough_replay(self):
+            """ Add tokens for the collected events and stop collecting. """
+            events = self.passthrough
+            self.passthrough = None
+            self.passthrough_depth = 0
+            self.passthrough_lock = self.passthrough_element.level
+            for key, arg in events:
+                self.append(getattr(self.formatter, key)(self, arg))
+
+        def passthrough_expand(self):
+            """Replace subtrees kept as parser events by tokens, if moving
+            whitespaces would insert a whitespace within or next to them.
+            Content models are complete, when the document is parsed."""
+            expand = {}
+            mixed = []
+            for tk in self._list:
+                if tk.name == "StartElement":
+                    mixed.append(tk.content_model in [2, 3])
+                elif tk.name == "EndElement":
+                    mixed.pop()
+                elif tk.name == "Passthrough" and tk.moves_whitespace(any(mixed[:-1])):
+                    expand[tk.pos] = tk.tokens()
+            if expand:
+                tokens = []
+                for tk in self._list:
+                    tokens.extend(expand.get(tk.pos, [tk]))
+                for pos, tk in enumerate(tokens):
+                    tk.pos = pos
+                self._list = tokens
 
         def level_increment(self):
             """ Increment level counter. """
@@ -221,7 +839,7 @@ class Formatter:
                 return self.desc_mixed_level is not None
             elif tk.name == "EndElement":
                 # Stop marking every descendant:
-                if tk.level is self.desc_mixed_level:
+                if tk.level == self.desc_mixed_level:
                     self.desc_mixed_level = None
                 elif self.desc_mixed_level is not None:
                     return True
@@ -235,8 +853,8 @@ class Formatter:
             None: next to last
             EndElement: first to previous"""
             if scheme == "EndElement" or (scheme is None and tk.end):
-                return reversed(self._list[: tk.pos])
-            return self._list[(tk.pos + 1) :]
+                return map(self._list.__getitem__, range(tk.pos - 1, -1, -1))
+            return map(self._list.__getitem__, range(tk.pos + 1, len(self._list)))
 
         def token_indent(self, tk):
             if self.formatter.inline:
@@ -260,19 +878,9 @@ class Formatter:
 
         def token_indent_inline(self, tk):
             """ Indent every element content - no matter enclosed by text or mixed content. """
-            for itk in iter(self.sequence(tk, "EndElement")):
-                if itk.level < tk.level and itk.name == "StartElement":
-                    if itk.content_model == 1:
-                        return True
-                    return False
-                if (
-                    itk.level == tk.level
-                    and tk.name == "EndElement"
-                    and itk.name == "StartElement"
-                ):
-                    if itk.content_model == 1:
-                        return True
-                    return False
+            # The innermost open element is the parent or the closed element:
+            if self.open_elements:
+                return self.open_elements[-1].content_model == 1
             return True
 
         def token_model(self, tk):
@@ -334,7 +942,11 @@ class Formatter:
             self, tk, start="StartElement", stop="EndElement", direct=False
         ):
             """ Add a whitspace to token list. """
+            backward = start == "EndElement"
             for itk in self.sequence(tk, start):
+                # Whitespaces inserted in between are empty:
+                if self.inserts.get(itk.pos + 1 if backward else itk.pos):
+                    break
                 if (
                     itk.empty
                     or (itk.name == stop and itk.descendant_mixed is False)
@@ -381,25 +993,281 @@ class Formatter:
             return False
 
         def insert_empty(self, tk, before=True):
-            """ Insert an Empty Token into token list - before or after tk. """
+            """Insert an Empty Token into token list - after tk, if before,
+            otherwise before tk. The token is spliced in by prepare."""
             if not (0 < tk.pos < (len(self) - 1)):
                 return False
-            ptk = self[tk.pos - 1]
+            gap = self.inserts.get(tk.pos, [])
+            ptk = gap[-1] if gap else self[tk.pos - 1]
             ntk = self.formatter.CharacterData(self, [" "])
             ntk.level = max(ptk.level, tk.level)
             ntk.descendant_mixed = tk.descendant_mixed
             ntk.preserve = ptk.preserve * tk.preserve
             ntk.cdata_section = ptk.cdata_section or tk.cdata_section
             if before:
-                self._list.insert(tk.pos + 1, ntk)
+                self.inserts.setdefault(tk.pos + 1, []).insert(0, ntk)
             else:
-                self._list.insert(tk.pos, ntk)
-            for i in range((tk.pos - 1), len(self._list)):
-                self._list[i].pos = i
+                self.inserts.setdefault(tk.pos, []).append(ntk)
 
         def xml_handler(self, key):
-            """ Returns lambda function which adds token to token list"""
-            return lambda *arg: self.append(getattr(self.formatter, key)(self, arg))
+            """ Returns function which adds token to token list"""
+            create = getattr(self.formatter, key)
+
+            def handler(*arg):
+                if self.passthrough is None:
+                    self.append(create(self, arg))
+                else:
+                    self.passthrough_event(key, arg)
+
+            return handler
+
+    class CompressList(TokenList):
+        """Token list of the compress engine, it formats compressed documents
+        only. Elements, text and CDATA sections are kept as records instead
+        of tokens: [name, arg, level, content model, preserve, descendant
+        mixed, cdata section]. Other tokens are kept in the arg of a record
+        named Token. The records are configured like their tokens and
+        rendered in a single pass without indenting."""
+
+        @classmethod
+        def applicable(cls, formatter):
+            """ Returns True, if the token list formats documents of formatter. """
+            return bool(formatter.compress)
+
+        def reset(self):
+            """ Start a new document by an empty token list and a new parser. """
+            super(Formatter.CompressList, self).reset()
+            # Render attributes by a token:
+            self.token = Formatter.Token(self, [])
+
+        def __getitem__(self, pos):
+            """ Returns the token of a record named Token. """
+            return self._list[pos][1]
+
+        def xml_handler(self, key):
+            """ Returns function which adds a record to token list """
+            if key == "StartElement":
+                return self.start_element
+            elif key == "EndElement":
+                return self.end_element
+            elif key == "CharacterData":
+                return self.character_data
+            elif key in ["StartCdataSection", "EndCdataSection"]:
+                return lambda: self.append([key, None, self.level_counter, None, False, False, False])
+            create = getattr(self.formatter, key)
+            return lambda *arg: self.append(
+                ["Token", create(self, arg), self.level_counter, None, False, False, False]
+            )
+
+        def append(self, rec):
+            """ Add record to token list. """
+            self._list.append(rec)
+
+        def start_element(self, name, attrs):
+            rec = ["StartElement", (name, attrs), self.level_counter, 0, 0, False, False]
+            self.level_counter += 1
+            if self.parse_elements:
+                self.parse_elements[-1][3] |= 1
+            self.parse_elements.append(rec)
+            self._list.append(rec)
+
+        def end_element(self, name):
+            self.level_counter -= 1
+            self.parse_elements.pop()
+            self._list.append(["EndElement", name, self.level_counter, None, 0, False, False])
+
+        def character_data(self, data):
+            if self.parse_elements and not Formatter.Token.re_blank.match(data):
+                self.parse_elements[-1][3] |= 2
+            self._list.append(["CharacterData", data, self.level_counter, None, False, False, False])
+
+        def prepare(self):
+            """Configure the records like TokenList.token_preserve and
+            TokenList.token_descendant_mixed, then move whitespaces."""
+            if self.prepared:
+                return
+            preserve = self.formatter.preserve
+            mixed_level = preserve_level = None
+            cdata = False
+            for rec in self._list:
+                kind, level = rec[0], rec[2]
+                if kind == "StartElement":
+                    if rec[3] in [2, 3] and mixed_level is None:
+                        mixed_level = level
+                        rec[5] = False
+                    else:
+                        rec[5] = mixed_level is not None
+                    if preserve_level is not None:
+                        rec[4] = 2
+                    elif rec[1][0] in preserve:
+                        preserve_level = level
+                        rec[4] = 1
+                elif kind == "EndElement":
+                    if level == mixed_level:
+                        mixed_level = None
+                    else:
+                        rec[5] = mixed_level is not None
+                    if rec[1] in preserve and level == preserve_level:
+                        preserve_level = None
+                        rec[4] = 1
+                    elif preserve_level is not None:
+                        rec[4] = 2
+                elif kind == "StartCdataSection":
+                    cdata = True
+                elif kind == "EndCdataSection":
+                    cdata = False
+                else:
+                    rec[4] = preserve_level is not None
+                    rec[5] = mixed_level is not None and mixed_level >= level - 1
+                    rec[6] = cdata
+            if self.formatter.correct:
+                self.whitespace_move()
+            self.prepared = True
+
+        def whitespace_move(self):
+            """Add whitespaces around text like CharacterData.pre_operate.
+            Inserted whitespaces are collected and spliced in at once."""
+            records = self._list
+            # Whitespaces to insert by the index of the next record:
+            inserts = {}
+            for i, rec in enumerate(records):
+                if (
+                    rec[0] == "CharacterData"
+                    and not rec[6]
+                    and not Formatter.Token.re_blank.match(rec[1])
+                ):
+                    if Formatter.Token.re_leading.search(rec[1]):
+                        self.whitespace_insert(inserts, i, -1)
+                    if Formatter.Token.re_trailing.search(rec[1]):
+                        self.whitespace_insert(inserts, i, 1)
+            if inserts:
+                spliced = []
+                for i, rec in enumerate(records):
+                    spliced.extend(inserts.get(i, ()))
+                    spliced.append(rec)
+                self._list = spliced
+
+        def whitespace_insert(self, inserts, i, step):
+            """Insert a whitespace next to the previous (step -1) or next
+            (step 1) text or element, like TokenList.whitespace_append, into
+            inserts by the index of the next record."""
+            records = self._list
+            if step < 0:
+                start, stop, positions = "EndElement", "StartElement", range(i - 1, -1, -1)
+            else:
+                start, stop, positions = "StartElement", "EndElement", range(i + 1, len(records))
+            for j in positions:
+                # Whitespaces inserted in between are empty:
+                if inserts.get(j + 1 if step < 0 else j):
+                    return
+                rec = records[j]
+                if rec[0] == "CharacterData":
+                    if Formatter.Token.re_empty.match(rec[1]):
+                        return
+                    elif not rec[6]:
+                        break
+                elif rec[0] == stop and not rec[5]:
+                    return
+                elif rec[0] == start:
+                    if abs(j - i) == 1:
+                        return
+                    elif rec[5]:
+                        break
+            else:
+                return
+            if not (0 < j < len(records) - 1):
+                return
+            gap = inserts.get(j, [])
+            prev = gap[-1] if gap else records[j - 1]
+            space = [
+                "CharacterData",
+                " ",
+                max(prev[2], rec[2]),
+                None,
+                prev[4] * rec[4],
+                rec[5],
+                prev[6] or rec[6],
+            ]
+            if step < 0:
+                inserts.setdefault(j + 1, []).insert(0, space)
+            else:
+                inserts.setdefault(j, []).append(space)
+
+        def delete_leading(self, i):
+            """ Returns True, like TokenList.whitespace_delete_leading. """
+            for j in range(i - 1, -1, -1):
+                rec = self._list[j]
+                if rec[0] == "CharacterData":
+                    return bool(Formatter.Token.re_trailing.search(rec[1]))
+                elif rec[0] in ["EndElement", "EndCdataSection"]:
+                    return False
+            return True
+
+        def delete_trailing(self, i):
+            """ Returns True, like TokenList.whitespace_delete_trailing. """
+            for j in range(i + 1, len(self._list)):
+                rec = self._list[j]
+                if rec[0] == "EndElement":
+                    return True
+                elif rec[0] in ["StartElement", "StartCdataSection"]:
+                    return False
+                elif (
+                    rec[0] == "CharacterData"
+                    and not rec[6]
+                    and not Formatter.Token.re_blank.match(rec[1])
+                ):
+                    return False
+            return True
+
+        def text(self, i, rec):
+            """ Returns the text of a record like CharacterData.__unicode__. """
+            str = rec[1]
+            if not rec[4] and not rec[6]:
+                if Formatter.Token.re_empty.match(str) and not rec[5]:
+                    str = ""
+                elif self.formatter.correct:
+                    leading = Formatter.Token.re_leading.search(str) and self.delete_leading(i)
+                    trailing = Formatter.Token.re_trailing.search(str) and self.delete_trailing(i)
+                    str = Formatter.CharacterData.re_space.sub(" ", str)
+                    if leading:
+                        str = re.sub(r"^\s", "", str)
+                    if trailing:
+                        str = re.sub(r"\s$", "", str)
+            if not rec[6]:
+                str = str.replace("&", "&amp;").replace("<", "&lt;")
+            return str
+
+        def render(self):
+            """ Yields the formatted XML document piece by piece. """
+            self.prepare()
+            records = self._list
+            close = " />" if self.formatter.selfclose_space else "/>"
+            last = ""
+            for i, rec in enumerate(records):
+                kind = rec[0]
+                if kind == "StartElement":
+                    piece = "<%s%s%s" % (
+                        rec[1][0],
+                        self.token.attributes(rec[1][1]),
+                        close if records[i + 1][0] == "EndElement" else ">",
+                    )
+                elif kind == "EndElement":
+                    piece = "" if records[i - 1][0] == "StartElement" else "</%s>" % rec[1]
+                elif kind == "CharacterData":
+                    piece = self.text(i, rec)
+                elif kind == "StartCdataSection":
+                    piece = "<![CDATA["
+                elif kind == "EndCdataSection":
+                    piece = "]]>"
+                else:
+                    rec[1].pos = i
+                    piece = str(rec[1])
+                if piece:
+                    last = piece
+                    yield piece
+            ending = self.formatter.eof_ending(last)
+            if ending:
+                yield ending
 
     class Token(object):
         def __init__(self, tklist, arg):
@@ -446,31 +1314,31 @@ class Formatter:
         def end(self):
             return self.name == "EndElement"
 
+        # Whitespaces of character data:
+        re_empty = re.compile(r"^[\t\s\n]*$")
+        re_blank = re.compile(r"^[\t\s\n]+$")
+        re_leading = re.compile(r"^[\t\s\n]+")
+        re_trailing = re.compile(r"[\t\s\n]+$")
+
         @property
         def empty(self):
-            return self.name == "CharacterData" and re.match(
-                r"^[\t\s\n]*$", self.arg[0]
-            )
+            return self.name == "CharacterData" and self.re_empty.match(self.arg[0])
 
         @property
         def leading(self):
-            return self.name == "CharacterData" and re.search(
-                r"^[\t\s\n]+", self.arg[0]
-            )
+            return self.name == "CharacterData" and self.re_leading.search(self.arg[0])
 
         @property
         def not_empty(self):
             return (
                 self.name == "CharacterData"
                 and not self.cdata_section
-                and not re.match(r"^[\t\s\n]+$", self.arg[0])
+                and not self.re_blank.match(self.arg[0])
             )
 
         @property
         def trailing(self):
-            return self.name == "CharacterData" and re.search(
-                r"[\t\s\n]+$", self.arg[0]
-            )
+            return self.name == "CharacterData" and self.re_trailing.search(self.arg[0])
 
         @property
         def start(self):
@@ -480,6 +1348,15 @@ class Formatter:
         def correct(self):
             return self.formatter.correct
 
+        @property
+        def compressed(self):
+            return self.compressed_at(self.level)
+
+        def compressed_at(self, level):
+            """ Returns True, if tokens of level are rendered compressed. """
+            depth = self.formatter.pretty_depth
+            return self.formatter.compress or (depth is not None and level > depth)
+
         def attribute(self, key, value):
             if key and value:
                 if not self.formatter.encode_attributes:
@@ -491,6 +1368,18 @@ class Formatter:
                 return ' %s=""' % (key)
             return ""
 
+        def attributes(self, attrs):
+            """ Returns the attributes of a start tag. """
+            str = ""
+            # see issue 4: for attr in attrs.keys():
+            if (self.formatter.preserve_attributes):
+                att_list = attrs.keys()
+            else:
+                att_list = sorted(attrs.keys())
+            for attr in att_list:
+                str += self.attribute(attr, attrs[attr])
+            return str
+
         def indent_insert(self):
             """ Indent token. """
             # Child of root and no empty node
@@ -504,7 +1393,8 @@ class Formatter:
 
         def indent_create(self, times=1):
             """ Returns indent string. """
-            if not self.formatter.compress and self.formatter.indent:
+            # End elements are indented like their children:
+            if not self.compressed_at(self.level + self.end) and self.formatter.indent:
                 return "\n%s" % (
                     (times * self.formatter.indent) * self.formatter.indent_char
                 )
@@ -550,27 +1440,28 @@ class Formatter:
             return str
 
     class CharacterData(Token):
+        # Line breaks, tabs and spaces are collapsed to a single space:
+        re_space = re.compile(r"\s+")
+
         def __unicode__(self):
             str = self.arg[0]
             if not self.preserve and not self.cdata_section:
                 # remove empty tokens always in element content!
                 if self.empty and not self.descendant_mixed:
-                    if self.formatter.blanks and not self.formatter.compress and re.match(r"\s*\n\s*\n\s*", str):
+                    if self.formatter.blanks and not self.compressed and re.match(r"\s*\n\s*\n\s*", str):
                         str = "\n"
                     else:
                         str = ""
                 else:
+                    self.post_operate()
                     if self.correct:
-                        str = re.sub(r"\r\n", "\n", str)
-                        str = re.sub(r"\r|\n|\t", " ", str)
-                        str = re.sub(r"\s+", " ", str)
+                        str = self.re_space.sub(" ", str)
                     if self.delete_leading:
                         str = re.sub(r"^\s", "", str)
                     if self.delete_trailing:
                         str = re.sub(r"\s$", "", str)
             if not self.cdata_section:
-                str = re.sub(r"&", "&amp;", str)
-                str = re.sub(r"<", "&lt;", str)
+                str = str.replace("&", "&amp;").replace("<", "&lt;")
             return str
 
         def pre_operate(self):
@@ -664,7 +1555,7 @@ class Formatter:
             str = ""
             # Don't close empty nodes on compression mode:
             if (
-                not (self.formatter.compress or self.formatter.selfclose)
+                not (self.compressed or self.formatter.selfclose)
                 or self.list[self.pos - 1].name != "StartElement"
             ):
                 if self.preserve in [0] and self.indent:
@@ -676,6 +1567,7 @@ class Formatter:
             self.descendant_mixed = self.list.token_descendant_mixed(self)
             self.preserve = self.list.token_preserve(self)
             self.indent = self.list.token_indent(self)
+            self.list.open_elements.pop()
 
     class EntityDecl(Token):
         def __unicode__(self):
@@ -702,6 +1594,183 @@ class Formatter:
             )
             return str
 
+    class Passthrough(Token):
+        """Subtree of a preserved element kept as parser events. Renders
+        like the tokens of the events without building them."""
+
+        def __init__(self, tklist, arg):
+            super(Formatter.Passthrough, self).__init__(tklist, arg)
+            # Content models of the start elements by event index, None for the preserved element:
+            self.models = self.events_model(self.arg[0])
+            # Indent comments and processing instructions by event index:
+            self.indents = {}
+
+        def events_model(self, events):
+            """ Returns content models like TokenList.token_model. """
+            models = {}
+            stack = [[None, 0]]
+            for i, (key, arg) in enumerate(events):
+                if key == "StartElement":
+                    stack[-1][1] |= 1
+                    stack.append([i, 0])
+                elif key == "EndElement":
+                    start, model = stack.pop()
+                    models[start] = model
+                elif key == "CharacterData" and not re.match(r"^[\t\s\n]+$", arg[0]):
+                    stack[-1][1] |= 2
+            models[None] = stack[0][1]
+            return models
+
+        def moves_whitespace(self, mixed):
+            """Returns True, if TokenList.whitespace_append would insert a
+            whitespace within the subtree or next to it, for the tokens of
+            the events. mixed is True, if an ancestor of the preserved
+            element has mixed content."""
+            if not self.formatter.correct:
+                return False
+            events = self.arg[0]
+            # Follow TokenList.token_descendant_mixed through the events:
+            if mixed:
+                mixed_level = -1
+            elif self.list[self.pos - 1].content_model in [2, 3]:
+                mixed_level = 0
+            else:
+                mixed_level = None
+            descendant_mixed = {}
+            cdata = set()
+            in_cdata = False
+            level = 1
+            for i, (key, arg) in enumerate(events):
+                if key == "StartElement":
+                    if self.models[i] in [2, 3] and mixed_level is None:
+                        mixed_level = level
+                        descendant_mixed[i] = False
+                    else:
+                        descendant_mixed[i] = mixed_level is not None
+                    level += 1
+                elif key == "EndElement":
+                    level -= 1
+                    descendant_mixed[i] = mixed_level is not None and mixed_level != level
+                    if mixed_level == level:
+                        mixed_level = None
+                elif key == "StartCdataSection":
+                    in_cdata = True
+                elif key == "EndCdataSection":
+                    in_cdata = False
+                elif in_cdata:
+                    cdata.add(i)
+            for i, (key, arg) in enumerate(events):
+                if key != "CharacterData" or i in cdata or self.re_blank.match(arg[0]):
+                    continue
+                for step, start, stop, match in [
+                    (-1, "EndElement", "StartElement", self.re_leading),
+                    (1, "StartElement", "EndElement", self.re_trailing),
+                ]:
+                    if not match.search(arg[0]):
+                        continue
+                    j = i + step
+                    while 0 <= j < len(events):
+                        name = events[j][0]
+                        if name == "CharacterData":
+                            if self.re_empty.match(events[j][1][0]):
+                                break
+                            elif not (j in cdata or self.re_blank.match(events[j][1][0])):
+                                return True
+                        elif name == stop and descendant_mixed[j] is False:
+                            break
+                        elif name == start:
+                            if abs(j - i) == 1:
+                                break
+                            elif descendant_mixed[j]:
+                                return True
+                        j += step
+                    else:
+                        # The preserved element is passed, if an ancestor has mixed content:
+                        if mixed:
+                            return True
+            return False
+
+        def tokens(self):
+            """ Returns the tokens of the events. """
+            level_counter = self.list.level_counter
+            self.list.level_counter = self.level
+            tokens = []
+            for i, (key, arg) in enumerate(self.arg[0]):
+                tk = getattr(self.formatter, key)(self.list, arg)
+                if key == "StartElement":
+                    tk.content_model = self.models[i]
+                tokens.append(tk)
+            self.list.level_counter = level_counter
+            return tokens
+
+        def configure(self):
+            super(Formatter.Passthrough, self).configure()
+            # Follow TokenList.token_indent through the events:
+            inline = self.formatter.inline
+            indent_level = self.list.indent_level
+            stack = [self.list[self.pos - 1].content_model]
+            level = self.level
+            for i, (key, arg) in enumerate(self.arg[0]):
+                if key == "StartElement":
+                    model = self.models[i]
+                    if not inline and model in [2, 3] and indent_level is None:
+                        indent_level = level
+                    stack.append(model)
+                    level += 1
+                elif key == "EndElement":
+                    stack.pop()
+                    level -= 1
+                    if not inline and level == indent_level:
+                        indent_level = None
+                elif key in ["Comment", "ProcessingInstruction"]:
+                    self.indents[i] = stack[-1] == 1 if inline else indent_level is None
+            self.list.indent_level = indent_level
+
+        def __unicode__(self):
+            events = self.arg[0]
+            pieces = []
+            cdata = False
+            level = self.level
+            for i, (key, arg) in enumerate(events):
+                if key == "StartElement":
+                    pieces.append("<%s" % arg[0])
+                    pieces.append(self.attributes(arg[1]))
+                    if (
+                        self.formatter.selfclose or self.compressed_at(level)
+                    ) and events[i + 1][0] == "EndElement":
+                        pieces.append(" />" if self.formatter.selfclose_space else "/>")
+                    else:
+                        pieces.append(">")
+                    level += 1
+                elif key == "EndElement":
+                    level -= 1
+                    if not (
+                        self.formatter.selfclose or self.compressed_at(level)
+                    ) or events[i - 1][0] != "StartElement":
+                        pieces.append("</%s>" % arg[0])
+                elif key == "CharacterData":
+                    if cdata:
+                        pieces.append(arg[0])
+                    else:
+                        pieces.append(arg[0].replace("&", "&amp;").replace("<", "&lt;"))
+                elif key == "StartCdataSection":
+                    pieces.append("<![CDATA[")
+                    cdata = True
+                elif key == "EndCdataSection":
+                    pieces.append("]]>")
+                    cdata = False
+                elif key == "Comment":
+                    if self.indents[i] and not self.compressed_at(level):
+                        pieces.append(self.indent_create(level))
+                    pieces.append("<!--%s-->" % re.sub(
+                        r"^[\r\n]+$", "\n", re.sub(r"^[\r\n]+", "\n", arg[0])
+                    ))
+                elif key == "ProcessingInstruction":
+                    if self.indents[i] and not self.compressed_at(level):
+                        pieces.append(self.indent_create(level))
+                    pieces.append("<?%s %s?>" % (arg[0], arg[1]))
+            return "".join(pieces)
+
     class ProcessingInstruction(Token):
         def __unicode__(self):
             str = ""
@@ -740,24 +1809,20 @@ class Formatter:
             if self.preserve in [0, 1] and self.indent:
                 str += self.indent_insert()
             str += "<%s" % self.arg[0]
-            # see issue 4: for attr in self.arg[1].keys():
-            if (self.formatter.preserve_attributes):
-                att_list = self.arg[1].keys()
-            else:
-                att_list = sorted(self.arg[1].keys())
-            for attr in att_list:
-                str += self.attribute(attr, self.arg[1][attr])
-            if self.list[self.pos + 1].end and (self.formatter.compress or self.formatter.selfclose):
+            str += self.attributes(self.arg[1])
+            if self.list[self.pos + 1].end and (self.compressed or self.formatter.selfclose):
                 str += " />" if self.formatter.selfclose_space else "/>"
             else:
                 str += ">"
             return str
 
         def configure(self):
-            self.content_model = self.list.token_model(self)
+            if self.content_model is None:
+                self.content_model = self.list.token_model(self)
             self.descendant_mixed = self.list.token_descendant_mixed(self)
             self.preserve = self.list.token_preserve(self)
             self.indent = self.list.token_indent(self)
+            self.list.open_elements.append(self)
 
     class XmlDecl(Token):
         def __init__(self, list, arg):
@@ -775,6 +1840,901 @@ class Formatter:
             str += "?>\n"
             return str
 
+    # Formatting engines by name, see Formatter.token_list:
+    engines = {"reference": TokenList, "compress": CompressList}
+
+
+# Formatter of the current worker of Formatter.format_many:
+format_many_worker = threading.local()
+
+
+def format_many_init(formatter):
+    """ Give the current worker its own copy of the Formatter. """
+    format_many_worker.formatter = copy.copy(formatter)
+
+
+def format_many_chunks(sources, chunksize, processes):
+    """ Yields lists of (index, source) pairs of up to chunksize length. """
+    chunk = []
+    for index, source in enumerate(sources):
+        # File objects can't be passed to another process:
+        if processes and hasattr(source, "read"):
+            source = source.read()
+        chunk.append((index, source))
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def format_many_chunk(chunk, method="format_source"):
+    """ Returns (index, result) pairs of a chunk formatted by method of the current worker. """
+    formatter = format_many_worker.formatter
+    apply = getattr(formatter, method)
+    results = []
+    for index, source in chunk:
+        # Pass errors of reading the source through:
+        if isinstance(source, Exception):
+            results.append((index, source))
+            continue
+        # Don't leak the encoding of the previous document:
+        formatter.encoding_internal = None
+        try:
+            results.append((index, apply(source)))
+        except Exception as err:
+            results.append((index, err))
+    return results
+
+
+def format_many_ordered(executor, chunks, window, method="format_source"):
+    """ Yields results in order of chunks, keeping up to window chunks pending. """
+    with executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(format_many_chunk, chunk, method))
+            if len(pending) >= window:
+                for index, result in pending.popleft().result():
+                    yield result
+        while pending:
+            for index, result in pending.popleft().result():
+                yield result
+
+
+def format_many_unordered(executor, chunks, window, method="format_source"):
+    """ Yields (index, result) pairs in order of completion, keeping up to window chunks pending. """
+    with executor:
+        pending = set()
+        for chunk in chunks:
+            pending.add(executor.submit(format_many_chunk, chunk, method))
+            if len(pending) >= window:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    for item in future.result():
+                        yield item
+        for future in concurrent.futures.as_completed(pending):
+            for item in future.result():
+                yield item
+
+
+def tree_feed(handlers, element, size=8192):
+    """Feed the parser events of an ElementTree element into handlers, by
+    handler name, in the order ET.tostring serializes it. Namespace
+    prefixes are assigned like ET.tostring does. Text is split like expat
+    reports the serialized text to a parser buffering size bytes. The tail
+    of element is left out, a parser would refuse text after the document
+    element."""
+    start_element = handlers["StartElementHandler"]
+    end_element = handlers["EndElementHandler"]
+    character_data = handlers["CharacterDataHandler"]
+    comment = xml.etree.ElementTree.Comment
+    processing_instruction = xml.etree.ElementTree.ProcessingInstruction
+    # Prefixed names by name and prefixes by URI like ET.tostring:
+    qnames, namespaces = tree_namespaces(element)
+    # Text up to the next event:
+    text = []
+    # Elements to start (element, namespaces, child) and to end (tag, tail):
+    pending = [(element, namespaces, False)]
+    while pending:
+        item = pending.pop()
+        if len(item) == 2:
+            tag, tail = item
+            if tag is not None:
+                if text:
+                    for chunk in tree_text_chunks("".join(text), size):
+                        character_data(chunk)
+                    text = []
+                end_element(tag)
+            if tail:
+                text.append(tail)
+            continue
+        element, namespaces, child = item
+        tag = element.tag
+        if tag is comment or tag is processing_instruction or qnames[tag] is not None:
+            if text:
+                for chunk in tree_text_chunks("".join(text), size):
+                    character_data(chunk)
+                text = []
+        if tag is comment:
+            handlers["CommentHandler"](tree_newlines("%s" % element.text))
+        elif tag is processing_instruction:
+            target, data = (re.split(r"[ \t\n]+", tree_newlines("%s" % element.text), 1) + [""])[:2]
+            handlers["ProcessingInstructionHandler"](target, data)
+        else:
+            tag = qnames[tag]
+            if tag is not None:
+                attrs = {}
+                # Namespaces are declared by the document element:
+                if namespaces:
+                    for uri, prefix in sorted(namespaces.items(), key=lambda x: x[1]):
+                        attrs["xmlns:" + prefix if prefix else "xmlns"] = uri
+                for key, value in element.items():
+                    if isinstance(key, xml.etree.ElementTree.QName):
+                        key = key.text
+                    if isinstance(value, xml.etree.ElementTree.QName):
+                        value = qnames[value.text]
+                    attrs[qnames[key]] = value
+                start_element(tag, attrs)
+            if element.text:
+                text.append(element.text)
+            pending.append((tag, element.tail if child else None))
+            pending.extend((sub, None, True) for sub in reversed(element))
+            continue
+        if child and element.tail:
+            text.append(element.tail)
+    for chunk in tree_text_chunks("".join(text), size):
+        character_data(chunk)
+
+
+def tree_namespaces(element):
+    """Returns the prefixed names by name and the prefixes by namespace URI
+    of the names used below element. Prefixes are registered ones, see
+    ET.register_namespace, or numbered ns0, ns1, ... in document order like
+    ET.tostring does."""
+    # The registry is private, present from Python 2.5 through 3.13:
+    registered = getattr(xml.etree.ElementTree, "_namespace_map", {})
+    qnames = {None: None}
+    namespaces = {}
+
+    def add(name):
+        if name[:1] == "{":
+            uri, local = name[1:].rsplit("}", 1)
+            prefix = namespaces.get(uri)
+            if prefix is None:
+                prefix = registered.get(uri)
+                if prefix is None:
+                    prefix = "ns%d" % len(namespaces)
+                if prefix != "xml":
+                    namespaces[uri] = prefix
+            qnames[name] = "%s:%s" % (prefix, local) if prefix else local
+        else:
+            qnames[name] = name
+
+    qname = xml.etree.ElementTree.QName
+    for sub in element.iter():
+        tag = sub.tag
+        if isinstance(tag, qname):
+            tag = tag.text
+        if isinstance(tag, str) and tag not in qnames:
+            add(tag)
+        for key, value in sub.items():
+            if isinstance(key, qname):
+                key = key.text
+            if key not in qnames:
+                add(key)
+            if isinstance(value, qname) and value.text not in qnames:
+                add(value.text)
+        if isinstance(sub.text, qname) and sub.text.text not in qnames:
+            add(sub.text.text)
+    return qnames, namespaces
+
+
+def tree_newlines(text):
+    """ Returns text with line breaks normalized like the parser does. """
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+# Pieces of serialized text expat reports one by one, see tree_text_chunks:
+TREE_TEXT_PIECES = re.compile(r"[^\n&<>\x80-\U0010ffff]+|[\s\S]")
+
+
+def tree_text_chunks(text, size):
+    """Returns text split like expat reports it serialized by ET.tostring
+    to a parser buffering size bytes: runs of ASCII, every line break,
+    entity and character reference on its own."""
+    text = tree_newlines(text)
+    # The buffer is never flushed within text up to size bytes:
+    if len(text) * 4 <= size or len(text.encode("utf-8", "surrogatepass")) <= size:
+        return [text] if text else []
+    chunks = []
+    used = 0
+    buf = []
+    for piece in TREE_TEXT_PIECES.findall(text):
+        length = len(piece.encode("utf-8", "surrogatepass"))
+        if used + length > size and buf:
+            chunks.append("".join(buf))
+            used = 0
+            buf = []
+        if length > size:
+            chunks.append(piece)
+        else:
+            buf.append(piece)
+            used += length
+    if buf:
+        chunks.append("".join(buf))
+    return chunks
+
+
+class SaxHandler(xml.sax.handler.ContentHandler):
+    """Feeds SAX events into a token list of formatter, see
+    Formatter.sax_handler. Comments are fed too, if the handler is set as
+    lexical handler of the SAX parser. Prefixed names are built from the
+    prefix mappings, if the parser reports namespaces. The formatted
+    document is returned by result()."""
+
+    def __init__(self, formatter):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.formatter = formatter
+        self.token_list = formatter.token_list()
+        self.handlers = dict(self.token_list.handlers)
+        # Character data up to the next event:
+        self.text = []
+        # Prefixes by namespace URI and the declarations of the next element:
+        self.prefixes = {}
+        self.declarations = []
+        # Skip the comments of the DTD:
+        self.dtd = False
+
+    def flush(self):
+        """ Feed the pending character data into the token list. """
+        if self.text:
+            for chunk in tree_text_chunks("".join(self.text), self.token_list.parser.buffer_size):
+                self.handlers["CharacterDataHandler"](chunk)
+            self.text = []
+
+    def event(self, key, *arg):
+        """ Feed an event into the token list, after the pending character data. """
+        self.flush()
+        self.handlers[key + "Handler"](*arg)
+
+    def qname(self, name):
+        """ Returns the prefixed name of a (uri, localname) pair. """
+        uri, localname = name
+        prefix = self.prefixes.get(uri, [None])[-1] if uri else None
+        return "%s:%s" % (prefix, localname) if prefix else localname
+
+    def startPrefixMapping(self, prefix, uri):
+        self.prefixes.setdefault(uri, []).append(prefix)
+        self.declarations.append(("xmlns:" + prefix if prefix else "xmlns", uri))
+
+    def endPrefixMapping(self, prefix):
+        for uri, prefixes in self.prefixes.items():
+            if prefixes and prefixes[-1] == prefix:
+                prefixes.pop()
+                break
+
+    def startElement(self, name, attrs):
+        attributes = dict(self.declarations)
+        self.declarations = []
+        attributes.update(attrs.items())
+        self.event("StartElement", name, attributes)
+
+    def startElementNS(self, name, qname, attrs):
+        attributes = dict(self.declarations)
+        self.declarations = []
+        for key, value in attrs.items():
+            attributes[attrs.getQNameByName(key) if key[0] else key[1]] = value
+        self.event("StartElement", qname or self.qname(name), attributes)
+
+    def endElement(self, name):
+        self.event("EndElement", name)
+
+    def endElementNS(self, name, qname):
+        self.event("EndElement", qname or self.qname(name))
+
+    def characters(self, content):
+        self.text.append(content)
+
+    def ignorableWhitespace(self, whitespace):
+        self.text.append(whitespace)
+
+    def processingInstruction(self, target, data):
+        if not self.dtd:
+            self.event("ProcessingInstruction", target, data)
+
+    def comment(self, content):
+        if not self.dtd:
+            self.event("Comment", content)
+
+    def startCDATA(self):
+        pass
+
+    def endCDATA(self):
+        pass
+
+    def startDTD(self, name, public_id, system_id):
+        self.dtd = True
+
+    def endDTD(self):
+        self.dtd = False
+
+    def endDocument(self):
+        self.flush()
+
+    def result(self):
+        """ Returns the formatted XML document. """
+        return self.formatter.enc_encode(str(self.token_list))
+
+
+class WsgiApplication(object):
+    """Format XML documents posted to a WSGI server. The request body is
+    parsed chunk by chunk on a worker pool and the formatted document is
+    streamed back. Formatter options are read from the query string, e.g.
+    ?indent=4&preserve=pre,literal. GET /metrics reports request counts and
+    latencies in the Prometheus text format."""
+
+    # Boolean options of the query string:
+    flags = [
+        "blanks",
+        "compress",
+        "correct",
+        "encode_attributes",
+        "eof_newline",
+        "inline",
+        "preserve_attributes",
+        "selfclose",
+        "selfclose_space",
+    ]
+    # Upper bounds of the latency histogram in seconds:
+    buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+    class TooLarge(Exception):
+        pass
+
+    def __init__(
+        self,
+        workers=DEFAULT_WORKERS,
+        max_size=DEFAULT_MAX_SIZE,
+        timeout=DEFAULT_TIMEOUT,
+        **options
+    ):
+        # Default options of the Formatter:
+        self.options = options
+        # Reject request bodies larger than max_size bytes:
+        self.max_size = max_size
+        # Reject requests not parsed within timeout seconds, rendering the
+        # prepared tokens is streamed and bounded by max_size instead:
+        self.timeout = timeout
+        # Parse and prepare documents by a pool of threads:
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        # Guard the metrics:
+        self.lock = threading.Lock()
+        # Count requests by status code:
+        self.requests = {}
+        # Count latencies by bucket, the last one is +Inf:
+        self.latency_counts = [0] * (len(self.buckets) + 1)
+        self.latency_sum = 0.0
+
+    def __call__(self, environ, start_response):
+        started = time.monotonic()
+        try:
+            if environ.get("PATH_INFO", "") == "/metrics":
+                status, headers, body = self.response_metrics()
+            elif environ.get("REQUEST_METHOD") != "POST":
+                status, headers, body = self.response_error("405 Method Not Allowed", "Use POST")
+                headers.append(("Allow", "POST"))
+            else:
+                status, headers, body = self.response_format(environ, started)
+        except Exception:
+            # Count requests failed by the server too:
+            self.observe("500 Internal Server Error", started)
+            raise
+        start_response(status, headers)
+        return WsgiApplication.Response(self, status, body, started)
+
+    class Response(object):
+        """ Stream the response body, observe the request on close. """
+
+        def __init__(self, app, status, body, started):
+            self.app = app
+            self.status = status
+            self.body = body
+            self.started = started
+
+        def __iter__(self):
+            return iter(self.body)
+
+        def close(self):
+            self.app.observe(self.status, self.started)
+
+    def formatter(self, query):
+        """ Returns a Formatter configured by the defaults and the query string. """
+        options = dict(self.options)
+        for key, values in urllib.parse.parse_qs(query).items():
+            key = key.replace("-", "_")
+            value = values[-1]
+            if key in self.flags:
+                options[key] = value.lower() in ["1", "on", "true", "yes"]
+            elif key == "preserve":
+                options[key] = value.replace(",", " ").split()
+            elif key in ["indent", "indent_char", "pretty_depth", "engine"]:
+                options[key] = value
+            elif key == "encoding":
+                options["encoding_input"] = value
+            elif key == "outencoding":
+                options["encoding_output"] = value
+            else:
+                raise ValueError("unknown option %s" % key)
+        for key in ["encoding_input", "encoding_output"]:
+            if options.get(key):
+                try:
+                    codecs.lookup(options[key])
+                except LookupError:
+                    raise ValueError("unknown encoding %s" % options[key])
+        return Formatter(**options)
+
+    def content_length(self, environ):
+        """ Returns the Content-Length of the request, None if not given. """
+        length = environ.get("CONTENT_LENGTH")
+        if not length:
+            return None
+        length = int(length)
+        if length < 0:
+            raise ValueError("negative length %d" % length)
+        return length
+
+    def read(self, environ):
+        """ Yields the request body in chunks. """
+        stream = environ["wsgi.input"]
+        length = self.content_length(environ)
+        if length is not None:
+            remaining = length
+        elif environ.get("wsgi.input_terminated"):
+            remaining = None
+        else:
+            return
+        while remaining is None or remaining > 0:
+            size = DEFAULT_CHUNK_SIZE if remaining is None else min(remaining, DEFAULT_CHUNK_SIZE)
+            chunk = stream.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+    def parse(self, formatter, chunks, deadline):
+        """ Feed chunks into the parser, returns the prepared token list. """
+        token_list = formatter.token_list()
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            if size > self.max_size:
+                raise WsgiApplication.TooLarge()
+            if time.monotonic() > deadline:
+                raise concurrent.futures.TimeoutError()
+            token_list.parser.Parse(chunk, False)
+        token_list.parser.Parse(b"", True)
+        token_list.prepare()
+        return token_list
+
+    def response_format(self, environ, started):
+        try:
+            formatter = self.formatter(environ.get("QUERY_STRING", ""))
+        except ValueError as err:
+            return self.response_error("400 Bad Request", "Option error: %s" % err)
+        try:
+            length = self.content_length(environ)
+        except ValueError:
+            return self.response_error(
+                "400 Bad Request", "Invalid Content-Length: %s" % environ.get("CONTENT_LENGTH")
+            )
+        if length is not None and length > self.max_size:
+            return self.response_too_large()
+        deadline = started + self.timeout
+        future = self.pool.submit(self.parse, formatter, self.read(environ), deadline)
+        try:
+            token_list = future.result(max(0, deadline - time.monotonic()))
+        except WsgiApplication.TooLarge:
+            return self.response_too_large()
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return self.response_timeout()
+        except xml.parsers.expat.ExpatError as err:
+            return self.response_error("400 Bad Request", "XML error: %s" % err)
+        except LookupError as err:
+            return self.response_error("400 Bad Request", "Encoding error: %s" % err)
+        return self.response_document(formatter, token_list)
+
+    def response_document(self, formatter, token_list):
+        # The document may declare an encoding unknown to Python:
+        try:
+            codecs.lookup(formatter.encoding_effective)
+        except LookupError as err:
+            return self.response_error("400 Bad Request", "Encoding error: %s" % err)
+        headers = [
+            ("Content-Type", "application/xml; charset=%s" % formatter.encoding_effective)
+        ]
+        return "200 OK", headers, formatter.enc_iterencode(token_list.render())
+
+    def response_error(self, status, message):
+        headers = [("Content-Type", "text/plain; charset=UTF-8")]
+        return status, headers, [("%s\n" % message).encode("utf-8")]
+
+    def response_too_large(self):
+        return self.response_error(
+            "413 Payload Too Large", "max document size (%s) exceeded" % self.max_size
+        )
+
+    def response_timeout(self):
+        return self.response_error(
+            "503 Service Unavailable", "time limit (%ss) exceeded" % self.timeout
+        )
+
+    def response_metrics(self):
+        headers = [("Content-Type", "text/plain; version=0.0.4; charset=UTF-8")]
+        return "200 OK", headers, [self.metrics().encode("utf-8")]
+
+    def observe(self, status, started):
+        """ Count a finished request and its latency. """
+        latency = time.monotonic() - started
+        code = status.split()[0]
+        with self.lock:
+            self.requests[code] = self.requests.get(code, 0) + 1
+            for i, bound in enumerate(self.buckets):
+                if latency <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            self.latency_counts[i] += 1
+            self.latency_sum += latency
+
+    def metrics(self):
+        """ Returns the metrics in the Prometheus text format. """
+        with self.lock:
+            lines = [
+                "# HELP xmlformat_requests_total Requests by status code.",
+                "# TYPE xmlformat_requests_total counter",
+            ]
+            for code in sorted(self.requests):
+                lines.append('xmlformat_requests_total{code="%s"} %d' % (code, self.requests[code]))
+            lines += [
+                "# HELP xmlformat_request_duration_seconds Request latency.",
+                "# TYPE xmlformat_request_duration_seconds histogram",
+            ]
+            count = 0
+            for bound, n in zip(self.buckets + ["+Inf"], self.latency_counts):
+                count += n
+                lines.append('xmlformat_request_duration_seconds_bucket{le="%s"} %d' % (bound, count))
+            lines.append("xmlformat_request_duration_seconds_sum %f" % self.latency_sum)
+            lines.append("xmlformat_request_duration_seconds_count %d" % count)
+        return "\n".join(lines) + "\n"
+
+
+class AsgiApplication(WsgiApplication):
+    """ASGI variant of WsgiApplication. Request chunks are fed into the
+    parser and response chunks are rendered on the worker pool, so the
+    event loop is never blocked by formatting."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        started = time.monotonic()
+        try:
+            if scope.get("path") == "/metrics":
+                status, headers, body = self.response_metrics()
+            elif scope.get("method") != "POST":
+                status, headers, body = self.response_error("405 Method Not Allowed", "Use POST")
+                headers.append(("Allow", "POST"))
+            else:
+                status, headers, body = await self.response_format_async(scope, receive, started)
+        except Exception:
+            # Count requests failed by the server too:
+            self.observe("500 Internal Server Error", started)
+            raise
+        try:
+            await self.send(send, status, headers, body)
+        finally:
+            self.observe(status, started)
+
+    async def send(self, send, status, headers, body):
+        """ Send the response, body chunks are rendered on the worker pool. """
+        loop = asyncio.get_event_loop()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": int(status.split()[0]),
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+            }
+        )
+        chunks = iter(body)
+        while True:
+            chunk = await loop.run_in_executor(self.pool, next, chunks, None)
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def response_format_async(self, scope, receive, started):
+        try:
+            formatter = self.formatter(scope.get("query_string", b"").decode("latin-1"))
+        except ValueError as err:
+            return self.response_error("400 Bad Request", "Option error: %s" % err)
+        loop = asyncio.get_event_loop()
+        deadline = started + self.timeout
+        token_list = formatter.token_list()
+        size = 0
+        try:
+            more_body = True
+            while more_body:
+                message = await asyncio.wait_for(receive(), max(0, deadline - time.monotonic()))
+                if message["type"] == "http.disconnect":
+                    return self.response_error("400 Bad Request", "Client disconnected")
+                chunk = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                size += len(chunk)
+                if size > self.max_size:
+                    return self.response_too_large()
+                await asyncio.wait_for(
+                    loop.run_in_executor(self.pool, token_list.parser.Parse, chunk, not more_body),
+                    max(0, deadline - time.monotonic()),
+                )
+            await asyncio.wait_for(
+                loop.run_in_executor(self.pool, token_list.prepare),
+                max(0, deadline - time.monotonic()),
+            )
+        except asyncio.TimeoutError:
+            return self.response_timeout()
+        except xml.parsers.expat.ExpatError as err:
+            return self.response_error("400 Bad Request", "XML error: %s" % err)
+        except LookupError as err:
+            return self.response_error("400 Bad Request", "Encoding error: %s" % err)
+        return self.response_document(formatter, token_list)
+
+
+class WsgiServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    """ Threaded WSGI server of the standard library. """
+
+    daemon_threads = True
+
+
+def serve(app, host="", port=8000):
+    """ Serve a WSGI application until interrupted. """
+    server = wsgiref.simple_server.make_server(host, port, app, server_class=WsgiServer)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def find_files(
+    root, include=DEFAULT_INCLUDE, exclude=[], gitignore=False, follow_symlinks=False
+):
+    """Yields the paths of files below root, whose name or path relative to
+    root matches a pattern of include but none of exclude. Directories
+    matching exclude are skipped. Honor .gitignore files if gitignore is
+    True. Symbolic links are skipped unless follow_symlinks is True."""
+    visited = set()
+    rules = {}
+    for top, dirs, files in os.walk(root, followlinks=follow_symlinks):
+        # Don't walk cycles of linked directories:
+        real = os.path.realpath(top)
+        if real in visited:
+            dirs[:] = []
+            continue
+        visited.add(real)
+        # Normalized paths, the root may be given with a trailing slash:
+        key = os.path.normpath(top)
+        parent = rules.get(os.path.normpath(os.path.dirname(top)), [])
+        if gitignore:
+            rules[key] = parent + gitignore_rules(top)
+        for name in sorted(dirs):
+            path = os.path.join(top, name)
+            if (
+                (not follow_symlinks and os.path.islink(path))
+                or files_match(root, path, exclude)
+                or (gitignore and (name == ".git" or gitignore_match(rules[key], path, True)))
+            ):
+                dirs.remove(name)
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(top, name)
+            if (
+                (follow_symlinks or not os.path.islink(path))
+                and files_match(root, path, include)
+                and not files_match(root, path, exclude)
+                and not (gitignore and gitignore_match(rules[key], path, False))
+            ):
+                yield path
+
+
+def files_match(root, path, patterns):
+    """ Returns True, if name or relative path of path matches a pattern. """
+    name = os.path.basename(path)
+    relpath = os.path.relpath(path, root).replace(os.sep, "/")
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relpath, pattern):
+            return True
+    return False
+
+
+def gitignore_rules(directory):
+    """Returns the rules of the .gitignore file in directory as tuples of
+    (directory, pattern, negate, directories only, anchored)."""
+    rules = []
+    try:
+        fh = open(os.path.join(directory, ".gitignore"), "r")
+    except IOError:
+        return rules
+    with fh:
+        for line in fh:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            rules.append((directory, line.lstrip("/"), negate, dir_only, anchored))
+    return rules
+
+
+def gitignore_match(rules, path, is_dir):
+    """ Returns True, if path is ignored by rules - the last matching rule wins. """
+    ignored = False
+    for directory, pattern, negate, dir_only, anchored in rules:
+        if dir_only and not is_dir:
+            continue
+        if anchored:
+            # Anchored to the directory of the .gitignore file:
+            relpath = os.path.relpath(path, directory).replace(os.sep, "/")
+            matched = gitignore_fnmatch(relpath.split("/"), pattern.split("/"))
+        else:
+            matched = fnmatch.fnmatch(os.path.basename(path), pattern)
+        if matched:
+            ignored = not negate
+    return ignored
+
+
+def gitignore_fnmatch(parts, patterns):
+    """Returns True, if the parts of a path match the parts of a pattern.
+    ** matches any number of parts, a trailing ** at least one."""
+    if not patterns:
+        return not parts
+    elif patterns[0] == "**":
+        first = 1 if len(patterns) == 1 else 0
+        return any(
+            gitignore_fnmatch(parts[i:], patterns[1:])
+            for i in range(first, len(parts) + 1)
+        )
+    elif parts and fnmatch.fnmatch(parts[0], patterns[0]):
+        return gitignore_fnmatch(parts[1:], patterns[1:])
+    return False
+
+
+def compression_of(fh, name=""):
+    """Returns the module of the compression of a binary file object by its
+    magic bytes, or by the extension of name, if fh can neither peek nor
+    seek. Returns None for uncompressed files."""
+    size = len(COMPRESSIONS[-1][0])
+    if hasattr(fh, "peek"):
+        head = fh.peek(size)
+    elif getattr(fh, "seekable", lambda: False)():
+        # Read the magic bytes and put them back:
+        head = fh.read(size)
+        fh.seek(-len(head), io.SEEK_CUR)
+    else:
+        head = None
+    for magic, extension, module in COMPRESSIONS:
+        if head is not None and head.startswith(magic):
+            return module
+        elif head is None and name.endswith(extension):
+            return module
+    return None
+
+
+def decompress_fileobj(fh, name=""):
+    """ Returns a binary file object reading fh decompressed, or fh if uncompressed. """
+    if not name and isinstance(getattr(fh, "name", None), str):
+        name = fh.name
+    module = compression_of(fh, name)
+    if module is None:
+        return fh
+    return module.open(fh, "rb")
+
+
+def open_input(path):
+    """ Returns a binary file object of path decompressed, - reads from STDIN. """
+    if path == "-":
+        return decompress_fileobj(sys.stdin.buffer)
+    fh = open(path, "rb")
+    module = compression_of(fh, path)
+    if module is None:
+        return fh
+    fh.close()
+    return module.open(path, "rb")
+
+
+def open_output(path, level=DEFAULT_COMPRESSION_LEVEL):
+    """Returns a binary file object writing to path, compressed by level,
+    if path ends with the extension of a compression."""
+    for magic, extension, module in COMPRESSIONS:
+        if path.endswith(extension):
+            if level is None:
+                return module.open(path, "wb")
+            elif module is lzma:
+                return module.open(path, "wb", preset=level)
+            return module.open(path, "wb", compresslevel=level)
+    return open(path, "wb")
+
+
+def read_file(path):
+    """ Returns the content of a file given by path name decompressed, - reads from STDIN. """
+    fh = open_input(path)
+    try:
+        return fh.read()
+    finally:
+        if fh is not sys.stdin.buffer:
+            fh.close()
+
+
+def read_file_or_error(path):
+    """ Returns the content of a file given by path name, or the exception raised reading it. """
+    try:
+        return read_file(path)
+    except Exception as err:
+        return err
+
+
+def read_chunks(path, size=DEFAULT_CHUNK_SIZE):
+    """ Yields the content of a file given by path name decompressed in chunks, - reads from STDIN. """
+    fh = open_input(path)
+    try:
+        for chunk in iter(lambda: fh.read(size), b""):
+            yield chunk
+    finally:
+        if fh is not sys.stdin.buffer:
+            fh.close()
+
+
+def read_ahead(executor, paths, window):
+    """Yields the contents of paths read by executor, keeping up to window
+    reads pending. The exception raised reading a path is yielded instead."""
+    pending = collections.deque()
+    for path in paths:
+        pending.append(executor.submit(read_file_or_error, path))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def format_files(formatter, paths, jobs=DEFAULT_JOBS, io_workers=DEFAULT_WORKERS, method="format_source"):
+    """Yields (path, result) pairs of files formatted by method of jobs
+    processes, or a thread if jobs is 1. The files are read ahead by
+    io_workers threads, so reading overlaps formatting."""
+    paths, pending = itertools.tee(paths)
+    with concurrent.futures.ThreadPoolExecutor(io_workers) as executor:
+        sources = read_ahead(executor, paths, io_workers * 4)
+        results = formatter.apply_many(
+            method, sources, jobs, True, jobs > 1, 8 if jobs > 1 else 1
+        )
+        for path, result in zip(pending, results):
+            yield path, result
+
 
 def cli_usage(msg=""):
     """ Output usage for command line tool. """
@@ -782,9 +2742,14 @@ def cli_usage(msg=""):
     sys.stderr.write(
         'Usage: xmlformat [--preserve "pre,literal"] [--blanks]\
  [--compress] [--selfclose] [--selfclose-space] [--indent num] [--indent-char char]\
- [--outfile file] [--encoding enc] [--outencoding enc]\
+ [--pretty-depth num] [--engine name]\
+ [--outfile file] [--compression-level num] [--encoding enc] [--outencoding enc]\
  [--disable-inlineformatting] [--overwrite] [--disable-correction]\
  [--eof-newline] [--preserve-attributes] [--encode-attributes]\
+ [--serve [host:]port] [--jobs num] [--check] [--validate] [--lines]\
+ [--split-bytes num] [--split-every num] [--split-depth num] [--report file]\
+ [--index file] [--index-depth num] [--index-key attr]\
+ [-r dir] [--include glob] [--exclude glob] [--gitignore] [--follow-symlinks]\
  [--help] <--infile file | file | - >\n'
     )
     sys.exit(2)
@@ -809,10 +2774,31 @@ def cli():
     eof_newline = DEFAULT_EOF_NEWLINE
     preserve_attributes = False
     encode_attributes = False
+    serve_address = None
+    jobs = DEFAULT_JOBS
+    directories = []
+    include = []
+    exclude = []
+    gitignore = False
+    follow_symlinks = False
+    check = False
+    validate = False
+    lines = False
+    pretty_depth = DEFAULT_PRETTY_DEPTH
+    engine = DEFAULT_ENGINE
+    compression_level = DEFAULT_COMPRESSION_LEVEL
+    split_bytes = None
+    split_every = None
+    split_depth = DEFAULT_SPLIT_DEPTH
+    report = None
+    index = None
+    index_depth = DEFAULT_INDEX_DEPTH
+    index_key = None
+    unformatted = []
     try:
         opts, args = getopt.getopt(
             sys.argv[1:],
-            "",
+            "r:",
             [
                 "compress",
                 "selfclose",
@@ -832,6 +2818,26 @@ def cli():
                 "eof-newline",
                 "preserve-attributes",
                 "encode-attributes",
+                "serve=",
+                "jobs=",
+                "recursive=",
+                "include=",
+                "exclude=",
+                "gitignore",
+                "follow-symlinks",
+                "check",
+                "validate",
+                "lines",
+                "pretty-depth=",
+                "engine=",
+                "compression-level=",
+                "split-bytes=",
+                "split-every=",
+                "split-depth=",
+                "report=",
+                "index=",
+                "index-depth=",
+                "index-key=",
             ],
         )
     except getopt.GetoptError as err:
@@ -873,32 +2879,100 @@ def cli():
             preserve_attributes = True
         elif key in ["--encode-attributes"]:
             encode_attributes = True
-            break
+        elif key in ["--serve"]:
+            serve_address = value
+        elif key in ["--jobs"]:
+            jobs = value
+        elif key in ["-r", "--recursive"]:
+            directories.append(value)
+        elif key in ["--include"]:
+            include += value.replace(",", " ").split()
+        elif key in ["--exclude"]:
+            exclude += value.replace(",", " ").split()
+        elif key in ["--gitignore"]:
+            gitignore = True
+        elif key in ["--follow-symlinks"]:
+            follow_symlinks = True
+        elif key in ["--check"]:
+            check = True
+        elif key in ["--validate"]:
+            validate = True
+        elif key in ["--lines"]:
+            lines = True
+        elif key in ["--pretty-depth"]:
+            pretty_depth = value
+        elif key in ["--engine"]:
+            if value not in Formatter.engines:
+                cli_usage("Unknown engine: %s" % value)
+            engine = value
+        elif key in ["--compression-level"]:
+            compression_level = value
+        elif key in ["--split-bytes"]:
+            split_bytes = value
+        elif key in ["--split-every"]:
+            split_every = value
+        elif key in ["--split-depth"]:
+            split_depth = value
+        elif key in ["--report"]:
+            report = value
+        elif key in ["--index"]:
+            index = value
+        elif key in ["--index-depth"]:
+            index_depth = value
+        elif key in ["--index-key"]:
+            index_key = value
+    if index is not None and (directories or len(args) > 1 or (infile and args)):
+        cli_usage("--index formats a single document")
+    options = dict(
+        indent=indent,
+        preserve=preserve,
+        blanks=blanks,
+        # A document per line requires compressed output:
+        compress=compress or lines,
+        selfclose=selfclose,
+        selfclose_space=selfclose_space,
+        encoding_input=encoding,
+        encoding_output=outencoding,
+        indent_char=indent_char,
+        inline=inline,
+        correct=correct,
+        eof_newline=eof_newline,
+        preserve_attributes=preserve_attributes,
+        encode_attributes=encode_attributes,
+        pretty_depth=pretty_depth,
+        engine=engine,
+        compression_level=compression_level,
+    )
+    if serve_address is not None:
+        host, _, port = serve_address.rpartition(":")
+        try:
+            port = int(port)
+        except ValueError:
+            cli_usage("Invalid address: %s" % serve_address)
+        serve(WsgiApplication(**options), host, port)
+        return
     try:
-        formatter = Formatter(
-            indent=indent,
-            preserve=preserve,
-            blanks=blanks,
-            compress=compress,
-            selfclose=selfclose,
-            selfclose_space=selfclose_space,
-            encoding_input=encoding,
-            encoding_output=outencoding,
-            indent_char=indent_char,
-            inline=inline,
-            correct=correct,
-            eof_newline=eof_newline,
-            preserve_attributes=preserve_attributes,
-            encode_attributes=encode_attributes,
-        )
-        if infile:
-            save_formatter_result(formatter.format_file(infile), formatter, overwrite, infile, outfile)
-        elif len(args) > 0:
-            if args[0] == "-":
-                save_formatter_result(formatter.format_string("".join(sys.stdin.readlines())), formatter, overwrite, None, outfile)
-            else:
-                for input_file in args:
-                    save_formatter_result(formatter.format_file(input_file), formatter, overwrite, input_file, outfile)
+        formatter = Formatter(**options)
+        if validate:
+            unformatted = cli_validate(formatter, infile, args, directories, include, exclude, gitignore, follow_symlinks, int(jobs))
+        elif check:
+            unformatted = cli_check(formatter, infile, args, directories, include, exclude, gitignore, follow_symlinks)
+        elif lines:
+            cli_lines(formatter, [infile] if infile else args or ["-"], overwrite, outfile)
+        elif index is not None:
+            cli_index(formatter, infile or (args or ["-"])[0], overwrite, outfile, index, int(index_depth), index_key)
+        elif split_bytes or split_every:
+            cli_split(formatter, infile or (args or ["-"])[0], outfile, int(split_depth), int(split_bytes or 0), int(split_every or 0))
+        elif report is not None and (infile or args or directories):
+            paths = cli_paths([infile] if infile else args, directories, include, exclude, gitignore, follow_symlinks)
+            cli_format_files(formatter, paths, int(jobs), overwrite, outfile, report)
+        elif infile:
+            save_formatter_result(formatter.format_stream(read_chunks(infile)), formatter, overwrite, infile, outfile)
+        elif len(args) > 0 and args[0] == "-":
+            save_formatter_result(formatter.format_stream(read_chunks("-")), formatter, overwrite, None, outfile)
+        elif len(args) > 0 or directories:
+            paths = cli_paths(args, directories, include, exclude, gitignore, follow_symlinks)
+            cli_format_files(formatter, paths, int(jobs), overwrite, outfile)
 
     except xml.parsers.expat.ExpatError as err:
         cli_usage("XML error: %s" % err)
@@ -906,6 +2980,202 @@ def cli():
         cli_usage("IO error: %s" % err)
     except:
         cli_usage("Unkonwn error")
+    if unformatted:
+        sys.exit(1)
+
+
+def cli_format_files(formatter, paths, jobs, overwrite, outfile, report=None):
+    """Format the files given by paths. If report is given, write the
+    measures of every file and a summary to report as JSON and raise the
+    first error after all files are formatted, otherwise at once."""
+    entries = []
+    errors = []
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(DEFAULT_WORKERS) as writer:
+        writes = []
+        method = "format_source" if report is None else "format_measured"
+        for input_file, res in format_files(formatter, paths, jobs, method=method):
+            if isinstance(res, xml.parsers.expat.ExpatError):
+                res = xml.parsers.expat.ExpatError("%s: %s" % (input_file, res))
+            if isinstance(res, Exception):
+                if report is None:
+                    raise res
+                entries.append({"path": input_file, "rewritten": False, "error": str(res)})
+                errors.append(res)
+                continue
+            if report is not None:
+                res, measures = res
+                changed = measures.pop("changed")
+                entry = {"path": input_file, "rewritten": overwrite and changed, "error": None}
+                entry.update(measures)
+                entries.append(entry)
+            if overwrite:
+                writes.append(writer.submit(formatter.enc_output, input_file, res))
+            else:
+                save_formatter_result(res, formatter, overwrite, input_file, outfile)
+        for write in writes:
+            write.result()
+    if report is not None:
+        with open(report, "w") as fh:
+            json.dump(report_summary(entries, time.perf_counter() - started), fh, indent=2)
+            fh.write("\n")
+    if errors:
+        raise errors[0]
+
+
+def report_summary(entries, seconds, slowest=DEFAULT_REPORT_SLOWEST):
+    """ Returns the report of the files given by entries formatted in seconds. """
+    measured = [entry for entry in entries if entry["error"] is None]
+    input_bytes = sum(entry["input_bytes"] for entry in measured)
+    ranked = sorted(measured, key=lambda entry: entry["parse_seconds"] + entry["format_seconds"], reverse=True)
+    return {
+        "files": entries,
+        "summary": {
+            "files": len(entries),
+            "errors": len(entries) - len(measured),
+            "rewritten": sum(1 for entry in measured if entry["rewritten"]),
+            "input_bytes": input_bytes,
+            "output_bytes": sum(entry["output_bytes"] for entry in measured),
+            "tokens": sum(entry["tokens"] for entry in measured),
+            "seconds": seconds,
+            "bytes_per_second": input_bytes / seconds if seconds else 0,
+            "slowest": [
+                {"path": entry["path"], "seconds": entry["parse_seconds"] + entry["format_seconds"]}
+                for entry in ranked[:slowest]
+            ],
+        },
+    }
+
+
+def cli_paths(args, directories, include, exclude, gitignore, follow_symlinks):
+    """ Returns an iterator of the files given by arguments and directories. """
+    return itertools.chain(
+        args,
+        *[
+            find_files(directory, include or DEFAULT_INCLUDE, exclude, gitignore, follow_symlinks)
+            for directory in directories
+        ]
+    )
+
+
+def cli_check(formatter, infile, args, directories, include, exclude, gitignore, follow_symlinks):
+    """ List files, which aren't formatted, returns their paths. """
+    unformatted = []
+    if len(args) > 0 and args[0] == "-":
+        paths = ["-"]
+    elif infile:
+        paths = [infile]
+    else:
+        paths = cli_paths(args, directories, include, exclude, gitignore, follow_symlinks)
+    paths, pending = itertools.tee(paths)
+    with concurrent.futures.ThreadPoolExecutor(DEFAULT_WORKERS) as executor:
+        for path, source in zip(paths, read_ahead(executor, pending, DEFAULT_WORKERS * 4)):
+            formatter.encoding_internal = None
+            try:
+                formatted = formatter.check_string(source)
+            except xml.parsers.expat.ExpatError as err:
+                raise xml.parsers.expat.ExpatError("%s: %s" % (path, err))
+            if not formatted:
+                sys.stdout.write("%s\n" % path)
+                unformatted.append(path)
+    return unformatted
+
+
+def cli_validate(formatter, infile, args, directories, include, exclude, gitignore, follow_symlinks, jobs):
+    """ Report files, which aren't well-formed, returns their paths. """
+    invalid = []
+    if len(args) > 0 and args[0] == "-":
+        paths = ["-"]
+        jobs = 1
+    elif infile:
+        paths = [infile]
+        jobs = 1
+    else:
+        paths = cli_paths(args, directories, include, exclude, gitignore, follow_symlinks)
+    paths, pending = itertools.tee(paths)
+    results = formatter.validate_many(
+        pending, workers=jobs, processes=jobs > 1, chunksize=8 if jobs > 1 else 1
+    )
+    for path, err in zip(paths, results):
+        if isinstance(err, xml.parsers.expat.ExpatError):
+            sys.stdout.write(
+                "%s:%d:%d: byte %d: %s\n"
+                % (path, err.lineno, err.offset, err.byte_index, xml.parsers.expat.ErrorString(err.code))
+            )
+            invalid.append(path)
+        elif err is not None:
+            # Unknown encodings and read errors don't stop the other files:
+            sys.stdout.write("%s: %s\n" % (path, err))
+            invalid.append(path)
+    return invalid
+
+
+def cli_lines(formatter, paths, overwrite, outfile):
+    """Format every line of the files given by paths as a XML document or
+    concatenated documents. Each line is formatted to one line."""
+    out = None
+    if not overwrite:
+        out = open_output(outfile, formatter.compression_level) if outfile else sys.stdout.buffer
+    for path in paths:
+        fh = open_input(path)
+        numbered, documents = itertools.tee(
+            (number, line.rstrip(b"\r\n")) for number, line in enumerate(fh, 1) if line.strip()
+        )
+        results = []
+        for (number, line), res in zip(numbered, formatter.format_documents(line for number, line in documents)):
+            if isinstance(res, Exception):
+                raise xml.parsers.expat.ExpatError("%s:%d: %s" % (path, number, res))
+            # Keep the XML declarations on the line of their documents:
+            res = re.sub(br"(<\?xml [^>]*\?>)\n", br"\1", res)
+            if not res.endswith(b"\n"):
+                res += b"\n"
+            if out is None:
+                results.append(res)
+            else:
+                out.write(res)
+        if fh is not sys.stdin.buffer:
+            fh.close()
+        if out is None:
+            formatter.enc_output(path, b"".join(results))
+    if out is not None:
+        out.flush()
+        if outfile:
+            out.close()
+
+
+def cli_split(formatter, infile, outfile, depth, split_bytes, split_every):
+    """Format the file given by infile into shards named after outfile or
+    infile, e.g. out.0001.xml, and write the manifest out.manifest.json."""
+    path = outfile or infile
+    if path == "-":
+        raise IOError("splitting STDIN requires --outfile")
+    base, extension = os.path.splitext(path)
+    if any(extension == compression[1] for compression in COMPRESSIONS):
+        base, inner = os.path.splitext(base)
+        extension = inner + extension
+    source = sys.stdin.buffer if infile == "-" else infile
+    shards = []
+    for i, (chunks, count) in enumerate(formatter.format_shards(source, depth, split_bytes, split_every), 1):
+        shard = "%s.%04d%s" % (base, i, extension)
+        chunks = list(chunks)
+        formatter.enc_output(shard, chunks)
+        shards.append({"file": os.path.basename(shard), "elements": count, "bytes": sum(len(chunk) for chunk in chunks)})
+    with open(base + ".manifest.json", "w") as fh:
+        json.dump({"source": infile, "depth": depth, "shards": shards}, fh, indent=2)
+        fh.write("\n")
+
+
+def cli_index(formatter, infile, overwrite, outfile, index, depth, key):
+    """Format the file given by infile and write the offsets of the
+    elements at depth as JSON lines to the file given by index."""
+    entries = []
+    source = sys.stdin.buffer if infile == "-" else infile
+    chunks = formatter.format_indexed(source, entries, depth, key)
+    save_formatter_result(chunks, formatter, overwrite, None if infile == "-" else infile, outfile)
+    with open(index, "w") as fh:
+        for entry in entries:
+            fh.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
 
 def save_formatter_result(res, formatter, overwrite, input_file, outfile):
     if overwrite: